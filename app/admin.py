@@ -1,21 +1,18 @@
 from django.contrib import admin
-from django.db.models import Sum
 
-from app.models import Product, Order
+from app.models import Product, Order, Job
 
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ("name", "thumbnail_preview", "price", "stock", "category", "rating")
-    search_fields = ("name", "category", "price")
+    list_display = ("name", "sku", "thumbnail_preview", "price", "stock", "category", "rating")
+    search_fields = ("name", "sku", "category", "price")
     list_filter = ("category",)
     exclude = ("created", "updated")
 
     @staticmethod
     def rating(obj):
-        if rating_count := obj.ratings.count():
-            return round(obj.ratings.aggregate(Sum("rating"))["rating__sum"] / rating_count, 1)
-        return 0
+        return obj.rating
 
 
 class ProductsInline(admin.TabularInline):
@@ -32,11 +29,20 @@ class ProductsInline(admin.TabularInline):
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ("id", "user", "total_amount", "created", "paid", "tracking_number")
+    list_display = ("id", "user", "total_amount", "item_count", "created", "paid", "tracking_number")
     search_fields = ("user", "created_at")
-    readonly_fields = ("id", "created", "user", "email", "name", "address", "tracking_number", "total_amount")
+    readonly_fields = ("id", "created", "user", "email", "name", "address", "tracking_number", "total_amount",
+                       "item_count", "lines")
     list_filter = ("total_amount", "created", "paid")
     inlines = [
         ProductsInline,
     ]
     exclude = ("updated", "ordered_items")
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "task", "status", "attempts", "run_at", "created")
+    search_fields = ("task",)
+    list_filter = ("status", "task")
+    readonly_fields = ("task", "kwargs", "attempts", "last_error", "created", "updated")
@@ -0,0 +1,302 @@
+"""Query count, latency and response size benchmarks of the API endpoints over synthetic catalogs"""
+import asyncio
+import time
+from collections import namedtuple
+from decimal import Decimal
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import AsyncClient
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from model_bakery import baker
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from app.cache import get_catalog_cache
+from app.db.base import DatabaseWrapper, close_pools
+from app.models import CartItem, Order, OrderItem, Product, ProductRating, get_order_summary
+from app.renderers import FastJSONRenderer
+from app.serializers import CartItemRowSerializer, CartItemSerializer, OrderSerializer, ProductRowSerializer, \
+    ProductSerializer
+
+Endpoint = namedtuple("Endpoint", ["name", "method", "url", "data"])
+
+ENDPOINTS = [
+    Endpoint("products-list", "get", lambda seed: reverse("product-list"), lambda seed: {"page_size": 100}),
+    Endpoint("products-detail", "get", lambda seed: reverse("product-detail", args=[seed["product"].id]), None),
+    Endpoint("products-search", "get", lambda seed: reverse("product-list"), lambda seed: {"search": "cream"}),
+    Endpoint("products-filter", "get", lambda seed: reverse("product-list"), lambda seed: {"category": "face"}),
+    Endpoint("rating-create", "post", lambda seed: reverse("rating-list"),
+             lambda seed: {"product": seed["product"].id, "rating": 4, "comment": "Nice"}),
+    Endpoint("cart-list", "get", lambda seed: reverse("cart-list"), None),
+    Endpoint("cart-create", "post", lambda seed: reverse("cart-list"),
+             lambda seed: {"product": seed["product"].id, "quantity": 1}),
+    Endpoint("orders-list", "get", lambda seed: reverse("order-list"), None),
+    Endpoint("orders-detail", "get", lambda seed: reverse("order-detail", args=[seed["order"].id]), None),
+    Endpoint("orders-create", "post", lambda seed: reverse("order-list"), lambda seed: {"paid": True}),
+]
+
+# product reads served by the WSGI path (DRF viewset) and the async views:
+# (endpoint, route, async route, seeded object passed as argument, query params)
+HANDLER_ENDPOINTS: list[tuple[str, str, str, str | None, dict | None]] = [
+    ("products-list", "product-list", "async-product-list", None, {"page_size": 100}),
+    ("products-detail", "product-detail", "async-product-detail", "product", None),
+    ("products-search", "product-list", "async-product-list", None, {"search": "cream"}),
+]
+
+# list endpoints serialized by a DRF serializer and by a row serializer
+SERIALIZERS = [
+    ("products-list", lambda: Product.objects.order_by("id"), ProductSerializer, ProductRowSerializer),
+    ("cart-list", lambda: CartItem.objects.select_related("product").order_by("id"), CartItemSerializer,
+     CartItemRowSerializer),
+]
+
+# connection handling compared by the connection load test: (mode, database settings)
+CONNECTION_MODES: list[tuple[str, dict]] = [
+    ("per-request", {"CONN_MAX_AGE": 0, "CONN_HEALTH_CHECKS": False, "POOL": None}),
+    ("persistent", {"CONN_MAX_AGE": 600, "CONN_HEALTH_CHECKS": True, "POOL": None}),
+    ("pooled", {"CONN_MAX_AGE": 0, "CONN_HEALTH_CHECKS": True, "POOL": {"MIN_SIZE": 1, "MAX_SIZE": 1}}),
+]
+
+
+class Rollback(Exception):
+    """Discards the data seeded for a single catalog size"""
+
+
+def seed_catalog(size: int) -> dict:
+    """Creates `size` products with ratings, and a shopper with a cart and orders growing with the catalog"""
+    products = baker.make(Product, name="Hydrating cream", category="face", price=10, stock=size * 10,
+                          _quantity=size, _bulk_create=True)
+    raters = baker.make(User, _quantity=2, _bulk_create=True)
+    ProductRating.objects.bulk_create(
+        ProductRating(product=product, user=user, rating=4, comment="Nice") for product in products for user in raters)
+    Product.objects.rebuild_rating_aggregates()
+    shopper = baker.make(User)
+    CartItem.objects.bulk_create(
+        CartItem(user=shopper, product=product, price=product.price, quantity=1) for product in products[:100])
+    orders = make_orders(shopper, products, Decimal(10))
+    return {"user": shopper, "product": products[0], "order": orders[0]}
+
+
+def make_orders(user: User, products: list[Product], price: Decimal) -> list[Order]:
+    """Creates an order of three of every product, with the summary checkout keeps on orders"""
+    items = [OrderItem(product=product, price=price, quantity=3) for product in products]
+    orders = Order.objects.bulk_create(
+        Order(user=user, total_amount=item.price * item.quantity,
+              **get_order_summary([item], {item.product_id: item.product.name})) for item in items)
+    for order, item in zip(orders, items):
+        item.order = order
+    OrderItem.objects.bulk_create(items)
+    return orders
+
+
+def measure(client: APIClient, endpoint: Endpoint, seed: dict, size: int) -> dict:
+    data = endpoint.data(seed) if endpoint.data else None
+    get_catalog_cache().clear()
+    with CaptureQueriesContext(connection) as queries:
+        started = time.perf_counter()
+        response = getattr(client, endpoint.method)(endpoint.url(seed), data)
+        wall_time = time.perf_counter() - started
+    return {
+        "endpoint": endpoint.name,
+        "size": size,
+        "status": response.status_code,
+        "queries": len(queries),
+        "wall_ms": round(wall_time * 1000, 3),
+        "bytes": len(response.content),
+    }
+
+
+def benchmark_size(size: int, endpoints: list[Endpoint]) -> list[dict]:
+    """Seeds a catalog, measures every endpoint against it and rolls the data back"""
+    results = []
+    try:
+        with transaction.atomic():
+            seed = seed_catalog(size)
+            client = APIClient()
+            client.force_authenticate(seed["user"])
+            results = [measure(client, endpoint, seed, size) for endpoint in endpoints]
+            raise Rollback
+    except Rollback:
+        return results
+
+
+def benchmark_serialization(rows: int, repeat: int = 5) -> list[dict]:
+    """Times fetching and serializing `rows` products and cart items with the DRF serializers and with
+    the row serializers, best of `repeat` runs"""
+    results = []
+    try:
+        with transaction.atomic():
+            products = baker.make(Product, name="Hydrating cream", price=10, stock=1, rating_count=3, rating_sum=13,
+                                  _quantity=rows, _bulk_create=True)
+            shopper = baker.make(User)
+            CartItem.objects.bulk_create(
+                CartItem(user=shopper, product=product, price=product.price, quantity=1) for product in products)
+            results = [compare_serializers(pair, get_serializer_context(), rows, repeat) for pair in SERIALIZERS]
+            raise Rollback
+    except Rollback:
+        return results
+
+
+def compare_serializers(pair: tuple, context: dict, rows: int, repeat: int) -> dict:
+    name, get_queryset, serializer_class, row_serializer_class = pair
+    serializer_ms = best_ms(lambda: serializer_class(list(get_queryset()), many=True, context=context).data, repeat)
+    row_serializer = row_serializer_class(context)
+    row_serializer_ms = best_ms(lambda: row_serializer.serialize(get_queryset().values(*row_serializer.fields)),
+                                repeat)
+    return {
+        "endpoint": name,
+        "rows": rows,
+        "serializer_ms_per_1k": round(serializer_ms * 1000 / rows, 3),
+        "row_serializer_ms_per_1k": round(row_serializer_ms * 1000 / rows, 3),
+        "speedup": round(serializer_ms / row_serializer_ms, 2),
+    }
+
+
+def benchmark_rendering(rows: int, repeat: int = 5) -> list[dict]:
+    """Times rendering product and order list payloads of `rows` items with the stdlib based DRF renderer
+    and with the renderer of the API, best of `repeat` runs"""
+    results = []
+    try:
+        with transaction.atomic():
+            products = baker.make(Product, name="Hydrating cream", price="10.90", stock=1, rating_count=3,
+                                  rating_sum=13, _quantity=rows, _bulk_create=True)
+            make_orders(baker.make(User), products, Decimal("10.90"))
+            payloads = {
+                "products-list": ProductRowSerializer(get_serializer_context()).serialize(
+                    Product.objects.values(*ProductRowSerializer.fields)),
+                "orders-list": OrderSerializer(Order.objects.all(), many=True, context=get_serializer_context()).data,
+            }
+            results = [compare_renderers(name, data, rows, repeat) for name, data in payloads.items()]
+            raise Rollback
+    except Rollback:
+        return results
+
+
+def compare_renderers(name: str, data, rows: int, repeat: int) -> dict:
+    json_ms = best_ms(lambda: JSONRenderer().render(data), repeat)
+    renderer_ms = best_ms(lambda: FastJSONRenderer().render(data), repeat)
+    return {
+        "payload": name,
+        "rows": rows,
+        "bytes": len(FastJSONRenderer().render(data)),
+        "json_ms": round(json_ms, 3),
+        "renderer_ms": round(renderer_ms, 3),
+        "speedup": round(json_ms / renderer_ms, 2),
+    }
+
+
+def get_serializer_context() -> dict:
+    return {"request": Request(APIRequestFactory().get("/"))}
+
+
+def best_ms(function, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+def benchmark_connections(requests: int) -> list[dict]:
+    """Times `requests` single query requests with a connection opened for every request, a persistent connection
+    and a pooled one, counting the server processes that served them"""
+    return [serve_requests(mode, overrides, requests) for mode, overrides in CONNECTION_MODES]
+
+
+def serve_requests(mode: str, overrides: dict, requests: int) -> dict:
+    database = DatabaseWrapper({**connection.settings_dict, **overrides}, alias=connection.alias)
+    started = time.perf_counter()
+    backends = {serve_request(database) for _ in range(requests)}
+    wall_time = time.perf_counter() - started
+    database.close()
+    close_pools()
+    return {
+        "mode": mode,
+        "requests": requests,
+        "connections": len(backends),
+        "wall_ms": round(wall_time * 1000, 3),
+        "ms_per_request": round(wall_time * 1000 / requests, 3),
+    }
+
+
+def serve_request(database: DatabaseWrapper) -> int:
+    # as the request_started and request_finished handlers of Django do
+    database.close_if_unusable_or_obsolete()
+    with database.cursor() as cursor:
+        cursor.execute("SELECT pg_backend_pid()")
+        backend = cursor.fetchone()[0]
+    database.close_if_unusable_or_obsolete()
+    return backend
+
+
+def benchmark_handlers(requests: int, size: int = 100) -> list[dict]:
+    """Times bursts of `requests` product reads through the WSGI handler one after another, as a single worker
+    serves them, and through the ASGI handler concurrently to the async views, over a seeded catalog.
+    Every burst starts from a cold catalog cache"""
+    results = []
+    try:
+        with transaction.atomic():
+            seed = seed_catalog(size)
+            results = [result for endpoint in HANDLER_ENDPOINTS
+                       for result in compare_handlers(endpoint, seed, size, requests)]
+            raise Rollback
+    except Rollback:
+        return results
+
+
+def compare_handlers(endpoint: tuple, seed: dict, size: int, requests: int) -> list[dict]:
+    name, route, async_route, arg, data = endpoint
+    args = [seed[arg].id] if arg else []
+    results = []
+    for handler, url, burst in (("wsgi", reverse(route, args=args), get_sync_burst),
+                                ("asgi", reverse(async_route, args=args), get_async_burst)):
+        get_catalog_cache().clear()
+        started = time.perf_counter()
+        statuses = burst(url, data, requests)
+        results.append({"endpoint": name, "handler": handler, "size": size, "requests": requests,
+                        "wall_ms": round((time.perf_counter() - started) * 1000, 3),
+                        "statuses": sorted(set(statuses))})
+    return results
+
+
+def get_sync_burst(url: str, data: dict | None, requests: int) -> list[int]:
+    client = APIClient()
+    return [client.get(url, data).status_code for _ in range(requests)]
+
+
+def get_async_burst(url: str, data: dict | None, requests: int) -> list[int]:
+    async def burst():
+        client = AsyncClient()
+        return await asyncio.gather(*(client.get(url, data) for _ in range(requests)))
+    return [response.status_code for response in async_to_sync(burst)()]
+
+
+def find_query_growth(results: list[dict]) -> list[str]:
+    """Returns endpoints whose query count changes with the catalog size"""
+    counts: dict = {}
+    for result in results:
+        counts.setdefault(result["endpoint"], set()).add(result["queries"])
+    return sorted(endpoint for endpoint, endpoint_counts in counts.items() if len(endpoint_counts) > 1)
+
+
+def run_benchmarks(sizes: list[int], endpoints: list[Endpoint] = ENDPOINTS, serialization_rows: int = 0,
+                   connection_requests: int = 0, handler_requests: int = 0) -> dict:
+    # a discarded pass over a tiny catalog warms up per-process caches and lazy imports
+    benchmark_size(1, endpoints)
+    results = [result for size in sizes for result in benchmark_size(size, endpoints)]
+    return {
+        "created": timezone.now().isoformat(),
+        "sizes": sizes,
+        "results": results,
+        "query_growth": find_query_growth(results),
+        "serialization": benchmark_serialization(serialization_rows) if serialization_rows else [],
+        "rendering": benchmark_rendering(serialization_rows) if serialization_rows else [],
+        "connections": benchmark_connections(connection_requests) if connection_requests else [],
+        "handlers": benchmark_handlers(handler_requests) if handler_requests else [],
+    }
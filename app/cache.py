@@ -0,0 +1,163 @@
+import time
+from calendar import timegm
+from hashlib import md5
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count, Max
+from django.http import Http404, HttpResponse, HttpResponseNotAllowed
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+from rest_framework.views import exception_handler
+
+from app.metrics import CATALOG_CACHE_REQUESTS
+from app.renderers import FastJSONRenderer
+
+CATALOG_VERSION_KEY = "catalog:version"
+
+
+def get_catalog_cache():
+    return caches[settings.CATALOG_CACHE_ALIAS]
+
+
+def get_catalog_version() -> int:
+    """Returns the time of the last catalog change in nanoseconds.
+    A version lost to eviction is replaced by the current time, so old entries are never served again"""
+    return get_catalog_cache().get_or_set(CATALOG_VERSION_KEY, time.time_ns, timeout=None)
+
+
+def bump_catalog_version():
+    """Invalidates every cached catalog response.
+    The version is bumped again after commit, dropping entries cached from reads made before the commit"""
+    def bump():
+        get_catalog_cache().set(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+    bump()
+    transaction.on_commit(bump)
+
+
+def get_catalog_cache_key(request, params, version: int) -> str:
+    params = urlencode(sorted(params.lists()), doseq=True)
+    url = md5(f"{request.build_absolute_uri(request.path)}?{params}".encode()).hexdigest()
+    return f"catalog:{version}:{url}"
+
+
+def make_cache_entry(data) -> tuple[str, object]:
+    """The ETag is a hash of the rendered data, so identical content gets the same ETag in every process and
+    after every refill, and content changed without a catalog version bump, like stock taken by checkouts,
+    gets a new one"""
+    return quote_etag(md5(FastJSONRenderer().render(data)).hexdigest()), data
+
+
+async def get_async_catalog_response(request, build):
+    """Answers a GET of an async view from the catalog cache with async cache calls, like CatalogCacheMixin.
+    On a miss, the response data is built by awaiting `build()`, which raises API exceptions for error responses"""
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    return await get_async_cached_response(request, build)
+
+
+async def get_async_cached_response(request, build):
+    try:
+        version, (etag, data) = await get_async_catalog_entry(request, build)
+    except (APIException, Http404) as error:
+        return render_error(error)
+    response = HttpResponse(FastJSONRenderer().render(data), content_type="application/json")
+    response["ETag"], response["Last-Modified"] = etag, http_date(version // 10 ** 9)
+    return get_conditional_response(request, etag=etag, last_modified=version // 10 ** 9, response=response)
+
+
+def render_error(error: Exception) -> HttpResponse:
+    """Renders an error outside of DRF views, as DRF's exception handler does"""
+    response = exception_handler(error, {})
+    return HttpResponse(FastJSONRenderer().render(response.data), status=response.status_code,
+                        content_type="application/json")
+
+
+async def get_async_catalog_entry(request, build) -> tuple[int, tuple[str, object]]:
+    cache = get_catalog_cache()
+    version = await cache.aget_or_set(CATALOG_VERSION_KEY, time.time_ns, timeout=None)
+    key = get_catalog_cache_key(request, request.GET, version)
+    cached = await cache.aget(key)
+    CATALOG_CACHE_REQUESTS.labels("miss" if cached is None else "hit").inc()
+    if cached is None:
+        cached = make_cache_entry(await build())
+        await cache.aset(key, cached, settings.CATALOG_CACHE_TIMEOUT)
+    return version, cached
+
+
+class CatalogCacheMixin:
+    """Serves list and retrieve responses from the catalog cache and answers conditional requests from it,
+    so a cache hit never touches the database. Entries are keyed on query params and the catalog version,
+    which product and rating changes bump"""
+
+    def list(self, request, *args, **kwargs):
+        return self.get_cached_response(super().list, request, *args, **kwargs)  # type: ignore[misc]
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_cached_response(super().retrieve, request, *args, **kwargs)  # type: ignore[misc]
+
+    def get_cached_response(self, action, request, *args, **kwargs):
+        version = get_catalog_version()
+        key = self.get_cache_key(request, version)
+        cached = get_catalog_cache().get(key)
+        CATALOG_CACHE_REQUESTS.labels("miss" if cached is None else "hit").inc()
+        if cached is None:
+            response = action(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            cached = self.cache_response(key, response)
+        etag, data = cached
+        response = Response(data, headers={"ETag": etag, "Last-Modified": http_date(version // 10 ** 9)})
+        return get_conditional_response(request, etag=etag, last_modified=version // 10 ** 9, response=response)
+
+    @staticmethod
+    def cache_response(key: str, response: Response) -> tuple[str, object]:
+        cached = make_cache_entry(response.data)
+        get_catalog_cache().set(key, cached, settings.CATALOG_CACHE_TIMEOUT)
+        return cached
+
+    @staticmethod
+    def get_cache_key(request, version: int) -> str:
+        return get_catalog_cache_key(request, request.query_params, version)
+
+
+class ConditionalResponseMixin:
+    """Answers If-None-Match/If-Modified-Since with 304 using validators derived from the `updated` column,
+    before anything is serialized"""
+
+    def get_conditional_response(self, action, validators: dict, request, *args, **kwargs):
+        if validators["last_modified"] is None:
+            return action(request, *args, **kwargs)
+        etag = quote_etag(md5(f"{request.user.pk}:{request.get_full_path()}:{validators}".encode()).hexdigest())
+        last_modified = timegm(validators["last_modified"].utctimetuple())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = action(request, *args, **kwargs)
+        response["ETag"], response["Last-Modified"] = etag, http_date(last_modified)
+        return response
+
+
+class ConditionalListMixin(ConditionalResponseMixin):
+    """Validates lists by the latest `updated` value and the row count, computed with one aggregate query"""
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset()).order_by()  # type: ignore[attr-defined]
+        validators = queryset.aggregate(last_modified=Max("updated"), count=Count("pk"))
+        action = super().list  # type: ignore[misc]
+        return self.get_conditional_response(action, validators, request, *args, **kwargs)
+
+
+class ConditionalRetrieveMixin(ConditionalResponseMixin):
+    """Validates a single object by its own `updated` value"""
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup = {self.lookup_field: kwargs[self.lookup_url_kwarg or self.lookup_field]}  # type: ignore[attr-defined]
+        queryset = self.filter_queryset(self.get_queryset()).filter(**lookup)  # type: ignore[attr-defined]
+        validators = {"last_modified": queryset.values_list("updated", flat=True).first()}
+        action = super().retrieve  # type: ignore[misc]
+        return self.get_conditional_response(action, validators, request, *args, **kwargs)
@@ -0,0 +1,342 @@
+"""Cart storage of the cart endpoints and checkout, configured by the CART_STORE setting.
+DatabaseCartStore keeps carts as cart item rows. KeyValueCartStore keeps every cart in a hash of a key-value store,
+a Redis server or process memory, so changing a cart does not write to the database. A cart is loaded from
+cart items on first use and written back to them only at checkout, or once it has been idle, see flush_carts"""
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils.module_loading import import_string
+
+from app.models import CartItem, Product
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+
+class WatchError(Exception):
+    """Raised by MemoryPipeline.execute when a watched key changed, as redis.WatchError is by Redis pipelines"""
+
+
+WATCH_ERRORS = (WatchError, redis.WatchError) if redis else (WatchError,)
+ROW_FIELDS = ["user", "product", "product__name", "price", "quantity"]
+DIRTY_KEY = "cart:dirty"
+
+
+@lru_cache(maxsize=None)
+def get_cart_store() -> "CartStore":
+    options = {name.lower(): value for name, value in settings.CART_STORE.items()}
+    return import_string(options.pop("backend"))(**options)
+
+
+class CartStore(ABC):
+    """Base of cart stores"""
+
+    def __init__(self, location: str = "", idle_flush_seconds: int = 900):
+        self.location = location
+        self.idle_flush_seconds = idle_flush_seconds
+
+    @abstractmethod
+    def add(self, user: User, product: Product, quantity: int) -> CartItem:
+        """Adds the quantity of a product at its current price"""
+
+    @abstractmethod
+    def get_items(self, user: User) -> list[CartItem]:
+        """Returns the items of a cart"""
+
+    @abstractmethod
+    def get_rows(self, user: User) -> list[dict]:
+        """Returns cart items as rows of ROW_FIELDS"""
+
+    @abstractmethod
+    def get_validators(self, user: User) -> dict:
+        """Returns the last modification time and the item count of a cart"""
+
+    @abstractmethod
+    def remove(self, user: User, items: list[CartItem]):
+        """Removes checked out items, within the transaction of the checkout"""
+
+    def flush_idle(self) -> int:
+        """Writes carts idle for `idle_flush_seconds` back to cart items, returns their number"""
+        return 0
+
+
+class DatabaseCartStore(CartStore):
+    """Keeps carts as cart item rows"""
+
+    def add(self, user: User, product: Product, quantity: int) -> CartItem:
+        return CartItem.objects.add(user, product, quantity)
+
+    def get_items(self, user: User) -> list[CartItem]:
+        return list(CartItem.objects.filter(user=user.id))
+
+    def get_rows(self, user: User) -> list[dict]:
+        return list(CartItem.objects.filter(user=user.id).values(*ROW_FIELDS))
+
+    def get_validators(self, user: User) -> dict:
+        return CartItem.objects.filter(user=user.id).aggregate(last_modified=Max("updated"), count=Count("pk"))
+
+    def remove(self, user: User, items: list[CartItem]):
+        CartItem.objects.filter(pk__in=[item.pk for item in items]).delete()
+
+
+def get_cart_key(user_id: int) -> str:
+    return f"cart:{user_id}"
+
+
+def dump_items(items: list[CartItem]) -> dict:
+    """Returns hash fields of cart items"""
+    cart: dict = {"updated": max((item.updated.timestamp() for item in items), default=0)}
+    for item in items:
+        cart.update({f"q:{item.product_id}": item.quantity, f"p:{item.product_id}": str(item.price)})
+    return cart
+
+
+def get_quantities(cart: dict) -> dict[int, int]:
+    return {int(field[2:]): int(value) for field, value in cart.items() if field.startswith("q:")}
+
+
+def load_items(user_id: int, cart: dict) -> list[CartItem]:
+    """Returns unsaved cart items of a cart hash, ordered by product"""
+    return [CartItem(user_id=user_id, product_id=product_id, price=Decimal(cart[f"p:{product_id}"]),
+                     quantity=quantity) for product_id, quantity in sorted(get_quantities(cart).items())]
+
+
+class KeyValueCartStore(CartStore):
+    """Keeps a cart in the hash "cart:<user id>", with quantities in "q:<product id>" fields,
+    prices in "p:<product id>" fields and the time of the last change in "updated".
+    Changed carts are listed in the sorted set "cart:dirty" by that time, until they are written back.
+    LOCATION is the url of a Redis server, without it carts are kept in process memory"""
+
+    def __init__(self, location: str = "", idle_flush_seconds: int = 900):
+        super().__init__(location, idle_flush_seconds)
+        self.client = get_client(location)
+
+    def load(self, user_id: int) -> dict:
+        """Returns the hash of a cart, filled from cart items when the store does not have it.
+        Fields are only set when missing, so a concurrent load never overwrites an addition"""
+        key = get_cart_key(user_id)
+        if cart := self.client.hgetall(key):
+            return cart
+        pipeline = self.client.pipeline()
+        for field, value in dump_items(list(CartItem.objects.filter(user=user_id))).items():
+            pipeline.hsetnx(key, field, value)
+        pipeline.hgetall(key)
+        return pipeline.execute()[-1]
+
+    def add(self, user: User, product: Product, quantity: int) -> CartItem:
+        key = get_cart_key(user.id)
+        self.load(user.id)
+        now = time.time()
+        pipeline = self.client.pipeline()
+        pipeline.hincrby(key, f"q:{product.id}", quantity)
+        pipeline.hset(key, mapping={f"p:{product.id}": str(product.price), "updated": now})
+        pipeline.zadd(DIRTY_KEY, {user.id: now})
+        total = pipeline.execute()[0]
+        return CartItem(user=user, product=product, price=product.price, quantity=total,
+                        updated=datetime.fromtimestamp(now, dt_timezone.utc))
+
+    def get_items(self, user: User) -> list[CartItem]:
+        return load_items(user.id, self.load(user.id))
+
+    def get_rows(self, user: User) -> list[dict]:
+        items = self.get_items(user)
+        names = dict(Product.objects.filter(pk__in=[item.product_id for item in items]).values_list("pk", "name"))
+        return [{"user": user.id, "product": item.product_id, "product__name": names[item.product_id],
+                 "price": item.price, "quantity": item.quantity} for item in items if item.product_id in names]
+
+    def get_validators(self, user: User) -> dict:
+        cart = self.load(user.id)
+        count = len(get_quantities(cart))
+        updated = datetime.fromtimestamp(float(cart["updated"]), dt_timezone.utc)
+        return {"last_modified": updated if count else None, "count": count}
+
+    def remove(self, user: User, items: list[CartItem]):
+        # rows of the cart written back while it was idle
+        CartItem.objects.filter(user=user.id).delete()
+        # products added since the checkout read the cart stay in it
+        if fields := [f"{prefix}:{item.product_id}" for item in items for prefix in "qp"]:
+            transaction.on_commit(lambda: self.drop(user.id, fields))
+
+    def drop(self, user_id: int, fields: list[str]):
+        """Deletes fields of a cart as a change of it, so a flush that read them beforehand does not complete
+        and the cart is written back again without them"""
+        now = time.time()
+        self.client.pipeline().hdel(get_cart_key(user_id), *fields) \
+            .hset(get_cart_key(user_id), mapping={"updated": now}).zadd(DIRTY_KEY, {user_id: now}).execute()
+
+    def flush_idle(self) -> int:
+        user_ids = self.client.zrangebyscore(DIRTY_KEY, 0, time.time() - self.idle_flush_seconds)
+        for user_id in user_ids:
+            self.flush(int(user_id))
+        return len(user_ids)
+
+    def flush(self, user_id: int):
+        """Writes a cart back to cart items and drops it from the store. The cart key is watched, so the cart
+        is kept when it changed meanwhile, and stays listed as changed for the next flush to write it back"""
+        key = get_cart_key(user_id)
+        with self.client.pipeline() as pipeline:
+            pipeline.watch(key)
+            items = load_items(user_id, pipeline.hgetall(key))
+            self.write_back(user_id, items)
+            pipeline.multi()
+            pipeline.delete(key).zrem(DIRTY_KEY, user_id)
+            try:
+                pipeline.execute()
+            except WATCH_ERRORS:
+                pass
+
+    @staticmethod
+    def write_back(user_id: int, items: list[CartItem]):
+        existing = set(Product.objects.filter(pk__in=[item.product_id for item in items]).values_list("pk", flat=True))
+        with transaction.atomic():
+            CartItem.objects.filter(user=user_id).delete()
+            CartItem.objects.bulk_create(item for item in items if item.product_id in existing)
+
+
+def get_client(location: str):
+    if not location:
+        return get_memory_client()
+    if redis is None:
+        raise ImproperlyConfigured("A CART_STORE location requires the redis package")
+    return redis.Redis.from_url(location, decode_responses=True)
+
+
+def get_memory_client() -> "MemoryHashClient":
+    """Carts in process memory are not shared between the worker processes of a server, every worker would keep
+    its own cart of a user. WEB_CONCURRENCY is the number of workers, exported by gunicorn.conf.py"""
+    if int(os.getenv("WEB_CONCURRENCY", 1)) > 1:
+        raise ImproperlyConfigured("KeyValueCartStore needs a CART_STORE location, a Redis server, "
+                                   "when serving with several worker processes")
+    return MemoryHashClient()
+
+
+class MemoryHashClient:
+    """In-process store implementing the Redis hash and sorted set commands cart stores use,
+    for tests and servers running a single process. Values are stored as strings, as Redis does.
+    Every change of a key bumps its version, which pipelines watching the key compare"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data: dict = {}
+        self.versions: Counter = Counter()
+
+    def pipeline(self) -> "MemoryPipeline":
+        return MemoryPipeline(self)
+
+    def hgetall(self, name: str) -> dict:
+        with self.lock:
+            return dict(self.data.get(name, {}))
+
+    def hget(self, name: str, key: str) -> str | None:
+        with self.lock:
+            return self.data.get(name, {}).get(key)
+
+    def hset(self, name: str, mapping: dict) -> int:
+        with self.lock:
+            self.data.setdefault(name, {}).update({key: str(value) for key, value in mapping.items()})
+            self.versions[name] += 1
+            return len(mapping)
+
+    def hsetnx(self, name: str, key: str, value) -> int:
+        with self.lock:
+            fields = self.data.setdefault(name, {})
+            if key in fields:
+                return 0
+            fields[key] = str(value)
+            self.versions[name] += 1
+            return 1
+
+    def hincrby(self, name: str, key: str, amount: int = 1) -> int:
+        with self.lock:
+            fields = self.data.setdefault(name, {})
+            fields[key] = str(int(fields.get(key, 0)) + amount)
+            self.versions[name] += 1
+            return int(fields[key])
+
+    def hdel(self, name: str, *keys: str) -> int:
+        with self.lock:
+            fields = self.data.get(name, {})
+            self.versions[name] += 1
+            return sum(fields.pop(key, None) is not None for key in keys)
+
+    def delete(self, *names: str) -> int:
+        with self.lock:
+            self.versions.update(names)
+            return sum(self.data.pop(name, None) is not None for name in names)
+
+    def zadd(self, name: str, mapping: dict) -> int:
+        with self.lock:
+            self.data.setdefault(name, {}).update({str(member): float(score) for member, score in mapping.items()})
+            self.versions[name] += 1
+            return len(mapping)
+
+    def zrangebyscore(self, name: str, min: float, max: float) -> list[str]:
+        with self.lock:
+            members = sorted(self.data.get(name, {}).items(), key=lambda member: member[1])
+            return [member for member, score in members if min <= score <= max]
+
+    def zrem(self, name: str, *members) -> int:
+        with self.lock:
+            scores = self.data.get(name, {})
+            self.versions[name] += 1
+            return sum(scores.pop(str(member), None) is not None for member in members)
+
+
+class MemoryPipeline:
+    """Queues commands and runs them at once under the lock of the client, like a MULTI/EXEC block.
+    As with Redis, commands run immediately from `watch` until `multi`, and `execute` raises WatchError,
+    running nothing, when a watched key changed since it was watched"""
+
+    def __init__(self, client: MemoryHashClient):
+        self.client = client
+        self.commands: list[tuple] = []
+        self.watched: dict[str, int] = {}
+        self.immediate = False
+
+    def __enter__(self) -> "MemoryPipeline":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def __getattr__(self, name: str):
+        command = getattr(self.client, name)
+        if self.immediate:
+            return command
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def reset(self):
+        self.commands, self.watched, self.immediate = [], {}, False
+
+    def watch(self, *names: str):
+        with self.client.lock:
+            self.watched.update({name: self.client.versions[name] for name in names})
+        self.immediate = True
+
+    def multi(self):
+        self.immediate = False
+
+    def execute(self) -> list:
+        with self.client.lock:
+            commands, watched = self.commands, self.watched
+            self.reset()
+            if any(self.client.versions[name] != version for name, version in watched.items()):
+                raise WatchError
+            return [command(*args, **kwargs) for command, args, kwargs in commands]
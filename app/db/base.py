@@ -0,0 +1,132 @@
+"""PostgreSQL backend with connection health checks and an optional connection pool shared by the threads of a process.
+Django 4.0 has no CONN_HEALTH_CHECKS, with it enabled a persistent connection is tested before its first query
+in a request and replaced when the server dropped it, as Django 4.1 does.
+With POOL configured, closing a connection at the end of a request returns it to the pool instead"""
+import threading
+
+from django.db.backends.postgresql import base
+from psycopg2 import pool
+from psycopg2.extras import register_default_jsonb
+
+pools: dict = {}
+pools_lock = threading.Lock()
+
+
+def is_usable(connection) -> bool:
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        # ends the transaction a connection not in autocommit mode has started
+        connection.rollback()
+    except base.Database.Error:
+        return False
+    return True
+
+
+class ConnectionPool(pool.ThreadedConnectionPool):
+    """Thread safe pool keeping up to `min_size` idle connections and opening up to `max_size`.
+    Waits up to `timeout` seconds for a connection when all are in use, instead of failing at once.
+    With `check`, idle connections are tested when handed out and the ones the server dropped are discarded"""
+
+    def __init__(self, min_size: int, max_size: int, timeout: float, check: bool, **conn_params):
+        super().__init__(min_size, max_size, **conn_params)
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.timeout = timeout
+        self.check = check
+
+    def getconn(self, key=None):
+        self.acquire_slot()
+        try:
+            return self.get_usable_connection()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def acquire_slot(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise pool.PoolError(f"No database connection available within {self.timeout}s")
+
+    def get_usable_connection(self):
+        connection = super().getconn()
+        while self.check and not is_usable(connection):
+            super().putconn(connection, close=True)
+            connection = super().getconn()
+        return connection
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self.slots.release()
+
+
+def get_pool(alias: str, conn_params: dict, settings_dict: dict) -> ConnectionPool:
+    """Returns the pool of a database, created on first use"""
+    options = settings_dict["POOL"]
+    key = (alias, repr(sorted(conn_params.items())))
+    with pools_lock:
+        if key not in pools:
+            pools[key] = ConnectionPool(options.get("MIN_SIZE", 1), options.get("MAX_SIZE", 10),
+                                        options.get("TIMEOUT", 10), settings_dict["CONN_HEALTH_CHECKS"],
+                                        **conn_params)
+        return pools[key]
+
+
+def close_pools():
+    """Closes every pooled connection, before a database is dropped for example"""
+    with pools_lock:
+        for connection_pool in pools.values():
+            connection_pool.closeall()
+        pools.clear()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """Connection settings, besides those of Django:
+    CONN_HEALTH_CHECKS - test persistent and pooled connections before they are used
+    POOL - pool options MIN_SIZE, MAX_SIZE and TIMEOUT, None or empty disables pooling"""
+    health_check_done = False
+    connection_pool: ConnectionPool | None = None
+
+    def __init__(self, settings_dict, *args, **kwargs):
+        settings_dict.setdefault("CONN_HEALTH_CHECKS", False)
+        settings_dict.setdefault("POOL", None)
+        super().__init__(settings_dict, *args, **kwargs)
+
+    def get_new_connection(self, conn_params):
+        if not self.settings_dict["POOL"]:
+            return super().get_new_connection(conn_params)
+        self.connection_pool = get_pool(self.alias, conn_params, self.settings_dict)
+        connection = self.connection_pool.getconn()
+        # the setup of PostgreSQL's DatabaseWrapper.get_new_connection
+        self.isolation_level = self.settings_dict["OPTIONS"].get("isolation_level", connection.isolation_level)
+        if self.isolation_level != connection.isolation_level:
+            connection.set_session(isolation_level=self.isolation_level)
+        register_default_jsonb(conn_or_curs=connection, loads=lambda x: x)
+        return connection
+
+    def connect(self):
+        super().connect()
+        self.health_check_done = True
+
+    def _close(self):
+        if self.connection_pool is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            self.connection_pool.putconn(self.connection, close=bool(self.connection.closed))
+        self.connection_pool = None
+
+    def _cursor(self, name=None):
+        self.close_if_health_check_failed()
+        return super()._cursor(name)
+
+    def close_if_health_check_failed(self):
+        if self.connection is None or self.health_check_done or not self.settings_dict["CONN_HEALTH_CHECKS"]:
+            return
+        if not self.is_usable():
+            self.close()
+        self.health_check_done = True
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # a connection kept for the next request is tested again before that request uses it
+        self.health_check_done = False
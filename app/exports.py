@@ -0,0 +1,81 @@
+"""Streaming exports of the product catalog.
+Rows are read with a server-side cursor and encoded chunk by chunk, so memory does not grow with the catalog"""
+import csv
+import json
+import zlib
+from typing import Callable, Iterable, Iterator
+
+from django.db.models import QuerySet
+from rest_framework.utils.encoders import JSONEncoder
+
+from app.models import get_average_rating
+
+EXPORT_CHUNK_SIZE = 2000
+STREAM_BUFFER_SIZE = 64 * 1024
+EXPORT_FIELDS = ["id", "sku", "name", "description", "image", "price", "stock", "category", "rating_count",
+                 "rating_sum", "created", "updated"]
+EXPORT_COLUMNS = ["id", "sku", "name", "description", "image", "price", "stock", "in_stock", "category", "rating",
+                  "rating_count", "created", "updated"]
+# output: (content type, file extension)
+OUTPUTS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+}
+
+
+def export_rows(queryset: QuerySet, image_url: Callable[[str], str]) -> Iterator[dict]:
+    """Yields products as plain dicts with the rating computed from stored aggregates"""
+    for product in queryset.values(*EXPORT_FIELDS).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        count, total = product.pop("rating_count"), product.pop("rating_sum")
+        product.update(
+            image=image_url(product["image"]) if product["image"] else None,
+            in_stock=product["stock"] > 0,
+            rating=get_average_rating(count, total),
+            rating_count=count,
+        )
+        yield product
+
+
+def encode_ndjson(rows: Iterable[dict]) -> Iterator[bytes]:
+    """Encodes rows with the encoder of the API, so prices are numbers as in API responses"""
+    for row in rows:
+        yield json.dumps(row, cls=JSONEncoder, ensure_ascii=False).encode() + b"\n"
+
+
+class LineBuffer:
+    """File-like object handing written lines back instead of storing them"""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def encode_csv(rows: Iterable[dict]) -> Iterator[bytes]:
+    writer = csv.DictWriter(LineBuffer(), fieldnames=EXPORT_COLUMNS)
+    yield writer.writeheader().encode()
+    for row in rows:
+        yield writer.writerow(row).encode()
+
+
+def buffered(chunks: Iterable[bytes], size: int = STREAM_BUFFER_SIZE) -> Iterator[bytes]:
+    """Joins small chunks, so a response is not written row by row"""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    yield bytes(buffer)
+
+
+def gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_export(queryset: QuerySet, output: str, compress: bool, image_url: Callable[[str], str]) -> Iterator[bytes]:
+    encode = encode_csv if output == "csv" else encode_ndjson
+    chunks = buffered(encode(export_rows(queryset, image_url)))
+    return gzipped(chunks) if compress else chunks
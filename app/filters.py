@@ -1,11 +1,111 @@
+import re
+from copy import copy
+from functools import lru_cache
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db import connections
+from django.db.models import Case, Count, Exists, F, FloatField, Q, QuerySet, When
+from django.db.models.functions import Cast
 from django_filters import rest_framework as filters
+from rest_framework.filters import SearchFilter
 
 from app.models import Product
 
 
 class CategoryFilter(filters.FilterSet):
     name = filters.CharFilter(field_name="name", lookup_expr="iexact")
+    min_price = filters.NumberFilter(field_name="price", lookup_expr="gte")
+    max_price = filters.NumberFilter(field_name="price", lookup_expr="lt")
 
     class Meta:
         model = Product
         fields = ["category"]
+
+
+# (min, max) price of facet buckets, max exclusive, None unbounded
+PRICE_BUCKETS = [(0, 10), (10, 25), (25, 50), (50, 100), (100, None)]
+
+
+def get_product_facets(queryset: QuerySet, category_base: QuerySet | None = None) -> dict:
+    """Counts products by category, stock and price bucket. With a category selected, categories are counted
+    over `category_base`, the products filtered by everything but the category, so the other categories keep
+    their counts. Without one, a single aggregate query counts every facet"""
+    price_filters = [Q(price__gte=low, **({"price__lt": high} if high else {})) for low, high in PRICE_BUCKETS]
+    category_counts = {f"category_{key}": Count("pk", filter=Q(category=key)) for key, _ in Product.CATEGORIES}
+    counts = queryset.order_by().aggregate(
+        **(category_counts if category_base is None else {}),
+        in_stock=Count("pk", filter=Q(stock__gt=0)),
+        out_of_stock=Count("pk", filter=Q(stock=0)),
+        **{f"price_{index}": Count("pk", filter=price_filter) for index, price_filter in enumerate(price_filters)},
+    )
+    if category_base is not None:
+        counts.update(category_base.order_by().aggregate(**category_counts))
+    return {
+        "category": {key: counts[f"category_{key}"] for key, _ in Product.CATEGORIES},
+        "stock": {"in_stock": counts["in_stock"], "out_of_stock": counts["out_of_stock"]},
+        "price": [{"min": low, "max": high, "count": counts[f"price_{index}"]}
+                  for index, (low, high) in enumerate(PRICE_BUCKETS)],
+    }
+
+
+def get_category_facet_base(request, view) -> QuerySet | None:
+    """Products of the view filtered by its filter backends as the request asks, except by category,
+    None when no category is selected"""
+    if not request.query_params.get("category"):
+        return None
+    request = without_query_param(request, "category")
+    queryset = view.get_queryset()
+    for backend in view.filter_backends:
+        queryset = backend().filter_queryset(request, queryset, view)
+    return queryset
+
+
+def without_query_param(request, name: str):
+    """Copy of the request, sharing its user and authentication, without the given query parameter"""
+    params = request.query_params.copy()
+    del params[name]
+    http_request = copy(request._request)
+    http_request.GET = params
+    request = copy(request)
+    request._request = http_request
+    return request
+
+
+class ProductSearchFilter(SearchFilter):
+    """Ranked full-text search over product name and description using the stored search vector.
+    When nothing matches, falls back to trigram similarity on name to tolerate typos, within the same query"""
+    search_config = "english"
+
+    def filter_queryset(self, request, queryset, view):
+        if not (terms := self.get_words(request)):
+            return queryset
+        query = SearchQuery(" & ".join(f"{term}:*" for term in terms), config=self.search_config, search_type="raw")
+        rank = Cast(SearchRank(F("search_vector"), query), FloatField())
+        if not trigram_available(queryset.db):
+            return queryset.annotate(search_rank=rank).filter(search_vector=query)
+        return self.filter_similar(queryset, query, rank, " ".join(terms))
+
+    @staticmethod
+    def filter_similar(queryset, query: SearchQuery, rank, text: str):
+        """Matches of the query, or products with a name similar to the text when the query matches none"""
+        similarity = Cast(TrigramSimilarity("name", text), FloatField())
+        unmatched = ~Exists(queryset.filter(search_vector=query))
+        queryset = queryset.annotate(search_rank=Case(When(search_vector=query, then=rank), default=similarity))
+        return queryset.filter(Q(search_vector=query) | Q(unmatched, name__trigram_similar=text))
+
+    def get_words(self, request) -> list[str]:
+        """Splits terms on punctuation as to_tsvector does, so 'anti-aging' searches 'anti' and 'aging'"""
+        return [word for term in self.get_search_terms(request) for word in re.split(r"\W+", term) if word]
+
+    def get_keyset_ordering(self, request, queryset, view):
+        if self.get_words(request):
+            return ["-search_rank", "id"]
+        return None
+
+
+@lru_cache
+def trigram_available(alias: str) -> bool:
+    """pg_trgm is a contrib extension, the migration only installs it where the server provides it"""
+    with connections[alias].cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return cursor.fetchone() is not None
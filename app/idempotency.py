@@ -0,0 +1,86 @@
+"""Idempotency keys of create endpoints.
+A client retrying a request sends the Idempotency-Key header of the first attempt. The response of the first
+request completed with a key is stored in the transaction of the create, and replayed to later requests with
+that key for IDEMPOTENCY_KEY_TTL seconds. Requests with the same key wait on a transaction level advisory lock
+of the key, so a duplicate sent while the first request runs gets its response instead of running again"""
+import json
+from datetime import timedelta
+from hashlib import md5
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from app.models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = "Idempotency key was used for another request"
+    default_code = "idempotency_key_reused"
+
+
+def get_fingerprint(request) -> str:
+    """Hashes the method, path and parsed body of a request, so formatting of the body does not matter"""
+    body = json.dumps(request.data, cls=JSONEncoder, sort_keys=True)
+    return md5(f"{request.method}:{request.path}:{body}".encode()).hexdigest()
+
+
+def get_expiry():
+    return timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+
+
+def validate_key(key: str):
+    max_length = IdempotencyKey._meta.get_field("key").max_length
+    if not 0 < len(key) <= max_length:
+        raise ValidationError({IDEMPOTENCY_HEADER: [f"Ensure this header has 1 to {max_length} characters"]})
+
+
+def lock_key(user_id: int, key: str):
+    """Waits for requests holding the key, until the end of the current transaction"""
+    with connections[router.db_for_write(IdempotencyKey)].cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", [user_id, key])
+
+
+def claim_key(request, key: str) -> IdempotencyKey | None:
+    """Locks the key for the current transaction, returns the stored response of the key if it has one"""
+    validate_key(key)
+    lock_key(request.user.id, key)
+    stored = IdempotencyKey.objects.filter(user=request.user.id, key=key, created__gte=get_expiry()).first()
+    if stored is not None and stored.fingerprint != get_fingerprint(request):
+        raise IdempotencyKeyReused()
+    return stored
+
+
+def store_response(request, key: str, response: Response):
+    """Stores a response, replacing the expired one of a key still waiting to be purged"""
+    IdempotencyKey.objects.update_or_create(user=request.user, key=key, defaults={
+        "fingerprint": get_fingerprint(request), "status_code": response.status_code,
+        "response": json.dumps(response.data, cls=JSONEncoder), "created": timezone.now()})
+
+
+def purge_expired_keys() -> int:
+    return IdempotencyKey.objects.filter(created__lt=get_expiry()).delete()[0]
+
+
+class IdempotentCreateMixin:
+    """Creates at most once per Idempotency-Key header of the user, answering retries with the stored response
+    without running the create again"""
+
+    def create(self, request, *args, **kwargs):
+        if (key := request.headers.get(IDEMPOTENCY_HEADER)) is None:
+            return super().create(request, *args, **kwargs)  # type: ignore[misc]
+        with transaction.atomic(using=router.db_for_write(IdempotencyKey)):
+            if (stored := claim_key(request, key)) is not None:
+                return Response(json.loads(stored.response), status=stored.status_code,
+                                headers={REPLAYED_HEADER: "true"})
+            response = super().create(request, *args, **kwargs)  # type: ignore[misc]
+            store_response(request, key, response)
+        return response
@@ -0,0 +1,64 @@
+from hashlib import sha256
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from app.cache import bump_catalog_version
+from app.jobs import enqueue
+from app.models import Product
+
+# name: (size, crop to the exact size)
+VARIANTS = {
+    "thumbnail": ((200, 200), True),
+    "small": ((400, 400), False),
+    "large": ((1200, 1200), False),
+}
+FORMATS = {
+    "jpeg": ("JPEG", "jpg"),
+    "webp": ("WEBP", "webp"),
+}
+VARIANTS_DIR = "products/variants"
+
+
+def generate_variants(image_file) -> dict:
+    """Resizes an uploaded image into every variant and format, named by the hash of the original content.
+    Returns variant paths by variant name and format"""
+    with image_file.open("rb") as source:
+        content = source.read()
+    digest = sha256(content).hexdigest()[:16]
+    image = ImageOps.exif_transpose(Image.open(BytesIO(content))).convert("RGB")
+    variants: dict = {"source": image_file.name}
+    for name, (size, crop) in VARIANTS.items():
+        resized = ImageOps.fit(image, size) if crop else ImageOps.contain(image, size)
+        variants[name] = {extension: save_variant(resized, f"{digest}-{name}", image_format)
+                          for extension, image_format in FORMATS.items()}
+    return variants
+
+
+def save_variant(image: Image.Image, name: str, image_format: tuple[str, str]) -> str:
+    pillow_format, extension = image_format
+    path = f"{VARIANTS_DIR}/{name}.{extension}"
+    if not default_storage.exists(path):
+        buffer = BytesIO()
+        image.save(buffer, format=pillow_format, quality=85, optimize=True)
+        default_storage.save(path, ContentFile(buffer.getvalue()))
+    return path
+
+
+def update_product_variants(product_id: int, force: bool = False) -> bool:
+    """Generates variants of a product image unless they are up to date.
+    The update is skipped when the image was replaced in the meantime"""
+    product = Product.objects.only("image", "image_variants").get(pk=product_id)
+    if not product.image or (product.has_image_variants and not force):
+        return False
+    variants = generate_variants(product.image)
+    updated = Product.objects.filter(pk=product_id, image=product.image.name).update(image_variants=variants)
+    bump_catalog_version()
+    return bool(updated)
+
+
+def schedule_product_variants(product_id: int):
+    """Queues generating variants as a background job, off the request path"""
+    enqueue(update_product_variants, product_id=product_id)
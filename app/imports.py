@@ -0,0 +1,174 @@
+"""Bulk product import.
+Feeds are streamed and validated in chunks, valid rows are copied into a temporary staging table,
+from which products are inserted or updated by sku with a single statement"""
+import csv
+import gzip
+import io
+import json
+import time
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+from django.core.exceptions import ValidationError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from app.cache import bump_catalog_version
+from app.models import Product
+
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_FIELDS = ["sku", "name", "description", "price", "stock", "category"]
+# values of optional columns missing or empty in a feed
+IMPORT_DEFAULTS = {"description": "", "stock": 0, "category": "other"}
+# descriptions are free text and may be empty, unlike in the admin
+VALIDATED_FIELDS = [Product._meta.get_field(name) for name in IMPORT_FIELDS if name != "description"]
+# sku is optional on products entered in the admin, but it is the key of imported ones
+MISSING_SKU = {"sku": [Product._meta.get_field("sku").error_messages["blank"]]}
+STAGING_TABLE = "product_import"
+
+CREATE_STAGING_SQL = f"""
+    CREATE TEMPORARY TABLE {STAGING_TABLE} (
+        row integer, sku varchar(64), name varchar(50), description text, price numeric(6, 2), stock integer,
+        category varchar(11)
+    ) ON COMMIT DROP
+"""
+# the last row of a sku wins, rows equal to the stored product are left alone and keep their `updated`
+UPSERT_SQL = f"""
+    WITH upserted AS (
+        INSERT INTO {Product._meta.db_table} (
+            sku, name, description, price, stock, category, image_variants, rating_count, rating_sum, created, updated
+        )
+        SELECT DISTINCT ON (sku) sku, name, description, price, stock, category, '{{}}', 0, 0, %(now)s, %(now)s
+        FROM {STAGING_TABLE}
+        ORDER BY sku, row DESC
+        ON CONFLICT (sku) DO UPDATE SET
+            name = EXCLUDED.name, description = EXCLUDED.description, price = EXCLUDED.price,
+            stock = EXCLUDED.stock, category = EXCLUDED.category, updated = EXCLUDED.updated
+        WHERE ({Product._meta.db_table}.name, {Product._meta.db_table}.description, {Product._meta.db_table}.price,
+               {Product._meta.db_table}.stock, {Product._meta.db_table}.category)
+            IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.description, EXCLUDED.price, EXCLUDED.stock, EXCLUDED.category)
+        RETURNING xmax = 0 AS inserted
+    )
+    SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted
+"""
+
+
+class ImportStats:
+    """Counts of an import in progress"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.loaded = 0
+        self.rejected = 0
+        self.inserted = 0
+        self.updated = 0
+
+    @property
+    def processed(self) -> int:
+        return self.loaded + self.rejected
+
+    @property
+    def rate(self) -> float:
+        """Processed rows per second"""
+        return self.processed / max(time.perf_counter() - self.started, 1e-9)
+
+
+def read_feed(path: str, feed_format: str) -> Iterator:
+    """Streams rows of a CSV or NDJSON file, optionally gzipped. NDJSON lines are parsed on validation"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as feed:
+        if feed_format == "csv":
+            yield from csv.DictReader(feed)
+        else:
+            yield from (line for line in feed if line.strip())
+
+
+def parse_json(line: str):
+    try:
+        return json.loads(line)
+    except ValueError as error:
+        raise ValidationError({"row": [f"Invalid JSON: {error}"]})
+
+
+def load_row(raw) -> dict:
+    row = parse_json(raw) if isinstance(raw, str) else raw
+    if not isinstance(row, dict):
+        raise ValidationError({"row": ["Expected an object"]})
+    return row
+
+
+def get_value(row: dict, name: str):
+    value = row.get(name)
+    return IMPORT_DEFAULTS.get(name) if value in (None, "") else value
+
+
+def clean_row(raw) -> list:
+    """Validates a row with the model fields and returns cleaned values of IMPORT_FIELDS"""
+    row = load_row(raw)
+    values = {name: get_value(row, name) for name in IMPORT_FIELDS}
+    if errors := get_field_errors(values) | ({} if values["sku"] else MISSING_SKU):
+        raise ValidationError(errors)
+    return [values[name] for name in IMPORT_FIELDS]
+
+
+def get_field_errors(values: dict) -> dict:
+    """Cleans values in place, like Model.clean_fields without instantiating a model per row"""
+    errors = {}
+    for field in VALIDATED_FIELDS:
+        if messages := clean_value(field, values):
+            errors[field.name] = messages
+    return errors
+
+
+def clean_value(field, values: dict) -> list[str]:
+    try:
+        values[field.name] = field.clean(values[field.name], None)
+    except ValidationError as error:
+        return error.messages
+    return []
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def validate_chunk(chunk: list, stats: ImportStats, on_reject: Callable) -> list[list]:
+    valid = [row for row in (validate_row(number, raw, stats, on_reject) for number, raw in chunk) if row]
+    stats.loaded += len(valid)
+    return valid
+
+
+def validate_row(number: int, raw, stats: ImportStats, on_reject: Callable) -> list | None:
+    try:
+        return [number, *clean_row(raw)]
+    except ValidationError as error:
+        stats.rejected += 1
+        on_reject(number, raw, error.message_dict)
+        return None
+
+
+def copy_to_staging(cursor, rows: list[list]):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    # an empty unquoted CSV value is NULL to COPY, unless forced to an empty string
+    cursor.copy_expert(f"COPY {STAGING_TABLE} (row, {', '.join(IMPORT_FIELDS)}) FROM STDIN "
+                       f"WITH (FORMAT csv, FORCE_NOT_NULL (description))", buffer)
+
+
+def import_products(rows: Iterable, on_reject: Callable, on_progress: Callable, chunk_size: int = IMPORT_CHUNK_SIZE,
+                    using: str = "default") -> ImportStats:
+    """Loads rows into products in a single transaction. Rejected rows are reported with their 1-based number
+    and errors, progress is reported after every chunk. The catalog cache is invalidated once"""
+    stats = ImportStats()
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute(CREATE_STAGING_SQL)
+        for chunk in chunked(enumerate(rows, start=1), chunk_size):
+            copy_to_staging(cursor, validate_chunk(chunk, stats, on_reject))
+            on_progress(stats)
+        cursor.execute(UPSERT_SQL, {"now": timezone.now()})
+        stats.inserted, stats.updated = cursor.fetchone()
+        bump_catalog_version()
+    return stats
@@ -0,0 +1,75 @@
+"""Database backed queue of background jobs.
+A job is inserted in the transaction enqueuing it, so workers see it once that transaction commits and never see
+jobs of rolled back ones. Workers claim due jobs with SELECT ... FOR UPDATE SKIP LOCKED and run each within the
+transaction holding its row lock, so a worker that dies releases its job to the others. Failed jobs are retried
+with exponential backoff, until they run out of attempts and are kept as failed"""
+import logging
+import threading
+import traceback
+from datetime import timedelta
+from typing import Callable
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from app.models import Job
+
+# seconds before the first retry, doubled by every failed attempt
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 3600
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(task: Callable, **kwargs) -> Job:
+    """Queues a call of a module level function with JSON serializable kwargs"""
+    return Job.objects.create(task=f"{task.__module__}.{task.__qualname__}", kwargs=kwargs)
+
+
+def get_retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY))
+
+
+def run_next_job() -> bool:
+    """Claims the job due first and runs it, returns False when no job is due"""
+    with transaction.atomic():
+        due = Job.objects.filter(status="queued", run_at__lte=timezone.now()).order_by("run_at")
+        if (job := due.select_for_update(skip_locked=True).first()) is None:
+            return False
+        run_job(job)
+    return True
+
+
+def run_job(job: Job):
+    """Deletes a job done, or schedules its retry. Changes of a failed attempt are rolled back"""
+    try:
+        with transaction.atomic():
+            import_string(job.task)(**job.kwargs)
+    except Exception as error:
+        retry_job(job, error)
+    else:
+        job.delete()
+
+
+def retry_job(job: Job, error: Exception):
+    job.attempts += 1
+    job.last_error = "".join(traceback.format_exception(error))
+    if job.attempts >= job.max_attempts:
+        job.status = "failed"
+        logger.error("Job %s of %s failed for good after %s attempts", job.id, job.task, job.attempts)
+    job.run_at = timezone.now() + get_retry_delay(job.attempts)
+    job.save(update_fields=["attempts", "last_error", "status", "run_at", "updated"])
+
+
+def work(stop: threading.Event, poll_interval: float = 1.0, burst: bool = False) -> int:
+    """Runs due jobs until `stop` is set, or until no job is due with `burst`. Returns the number of jobs run"""
+    processed = 0
+    while not stop.is_set():
+        # a long running worker drops connections past their age or broken, as request handlers do
+        close_old_connections()
+        ran = run_next_job()
+        processed += ran
+        if not ran and (burst or stop.wait(poll_interval)):
+            break
+    return processed
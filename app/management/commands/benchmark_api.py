@@ -0,0 +1,47 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.test.runner import DiscoverRunner
+
+from app.benchmarks import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = "Measures query counts, wall time and response sizes of API endpoints over synthetic catalogs, " \
+           "using a throwaway test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="Catalog sizes")
+        parser.add_argument("--output", help="File to write the JSON report to, defaults to stdout")
+        parser.add_argument("--serialization-rows", type=int, default=1000,
+                            help="Rows serialized and rendered comparing DRF and the API's serializers and renderer, "
+                                 "0 skips the comparisons")
+        parser.add_argument("--connection-requests", type=int, default=200,
+                            help="Requests served per connection handling mode, 0 skips the connection load test")
+        parser.add_argument("--handler-requests", type=int, default=50,
+                            help="Product reads per burst comparing the WSGI path and the async views, "
+                                 "0 skips the comparison")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0)
+        old_config = runner.setup_databases()
+        try:
+            report = run_benchmarks(options["sizes"], serialization_rows=options["serialization_rows"],
+                                    connection_requests=options["connection_requests"],
+                                    handler_requests=options["handler_requests"])
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+        self.write_report(report, options["output"])
+        if report["query_growth"]:
+            raise CommandError(f"Query count grows with catalog size: {', '.join(report['query_growth'])}")
+
+    def write_report(self, report: dict, output: str | None):
+        content = json.dumps(report, indent=2)
+        if output is None:
+            self.stdout.write(content)
+            return
+        with open(output, "w") as report_file:
+            report_file.write(content)
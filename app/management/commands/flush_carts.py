@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app.carts import get_cart_store
+
+
+class Command(BaseCommand):
+    help = "Writes carts of the cart store idle for its IDLE_FLUSH_SECONDS back to cart items"
+
+    def handle(self, *args, **options):
+        flushed = get_cart_store().flush_idle()
+        self.stdout.write(self.style.SUCCESS(f"Flushed {flushed} idle carts"))
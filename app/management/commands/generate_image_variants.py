@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from app.images import update_product_variants
+from app.models import Product
+
+
+class Command(BaseCommand):
+    help = "Generates resized variants of product images that are missing or outdated"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Regenerate variants of every product image")
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image="").exclude(image__isnull=True).values_list("id", flat=True)
+        generated = sum(update_product_variants(product_id, options["force"]) for product_id in products.iterator())
+        self.stdout.write(self.style.SUCCESS(f"Generated image variants of {generated} products"))
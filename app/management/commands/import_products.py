@@ -0,0 +1,49 @@
+import json
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.imports import IMPORT_CHUNK_SIZE, ImportStats, import_products, read_feed
+
+
+class Command(BaseCommand):
+    help = "Inserts or updates products by sku from a CSV or NDJSON feed, optionally gzipped"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Feed file, .csv, .ndjson or .jsonl, with an optional .gz suffix")
+        parser.add_argument("--format", choices=["csv", "ndjson"], help="Feed format, defaults to the file suffix")
+        parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE, help="Rows validated per chunk")
+        parser.add_argument("--rejects", help="File to write rejected rows with their errors to, as NDJSON")
+
+    def handle(self, *args, **options):
+        feed_format = options["format"] or self.detect_format(options["path"])
+        with open(options["rejects"], "w") if options["rejects"] else nullcontext() as rejects:
+            try:
+                stats = import_products(read_feed(options["path"], feed_format), self.get_reject_writer(rejects),
+                                        self.write_progress, options["chunk_size"])
+            except FileNotFoundError as error:
+                raise CommandError(error)
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats.loaded} rows at {stats.rate:.0f} rows/s: {stats.inserted} products created, "
+            f"{stats.updated} updated, {stats.loaded - stats.inserted - stats.updated} unchanged, "
+            f"{stats.rejected} rows rejected"))
+
+    @staticmethod
+    def detect_format(path: str) -> str:
+        name = path.removesuffix(".gz")
+        if name.endswith(".csv"):
+            return "csv"
+        if name.endswith((".ndjson", ".jsonl")):
+            return "ndjson"
+        raise CommandError(f"Unknown feed format of {path}, use --format")
+
+    def get_reject_writer(self, rejects):
+        def write_reject(number: int, row, errors: dict):
+            if rejects is None:
+                self.stderr.write(f"Row {number} rejected: {json.dumps(errors)}")
+                return
+            rejects.write(json.dumps({"row": number, "errors": errors, "data": row}, default=str) + "\n")
+        return write_reject
+
+    def write_progress(self, stats: ImportStats):
+        self.stdout.write(f"{stats.processed} rows processed, {stats.rejected} rejected, {stats.rate:.0f} rows/s")
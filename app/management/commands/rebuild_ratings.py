@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.models import Product
+
+
+class Command(BaseCommand):
+    help = "Recalculates rating count and rating sum stored on every product"
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        updated = Product.objects.rebuild_rating_aggregates()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt rating aggregates of {updated} products"))
@@ -0,0 +1,59 @@
+import multiprocessing
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from app.jobs import work
+
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+def run_worker(poll_interval: float, burst: bool) -> int:
+    """Works until SIGTERM or SIGINT, which let the job at hand finish"""
+    stop = threading.Event()
+    previous = {signum: signal.signal(signum, lambda *args: stop.set()) for signum in STOP_SIGNALS}
+    try:
+        return work(stop, poll_interval, burst)
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+def terminate(workers: list):
+    for worker in workers:
+        worker.terminate()
+
+
+class Command(BaseCommand):
+    help = "Runs queued background jobs in one or more worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1, help="Worker processes")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds an idle worker waits before looking for due jobs again")
+        parser.add_argument("--burst", action="store_true", help="Stop once no job is due, instead of waiting")
+
+    def handle(self, *args, **options):
+        worker_args = (options["poll_interval"], options["burst"])
+        if options["processes"] == 1:
+            processed = run_worker(*worker_args)
+            self.stdout.write(self.style.SUCCESS(f"Ran {processed} jobs"))
+            return
+        self.run_processes(options["processes"], worker_args)
+        self.stdout.write(self.style.SUCCESS(f"Stopped {options['processes']} workers"))
+
+    @staticmethod
+    def run_processes(count: int, worker_args: tuple):
+        # forked workers must open connections of their own
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=run_worker, args=worker_args) for _ in range(count)]
+        for worker in workers:
+            worker.start()
+        # workers get SIGINT of a terminal from the process group, SIGTERM is passed on to them
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda *args: terminate(workers))
+        for worker in workers:
+            worker.join()
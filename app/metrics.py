@@ -0,0 +1,50 @@
+"""Prometheus metrics of the API.
+With PROMETHEUS_MULTIPROC_DIR set before start, every worker process writes its samples to files in that
+directory and the metrics endpoint aggregates them, see prometheus_client multiprocess mode. The server must then
+mark exited workers dead, as the child_exit hook of gunicorn.conf.py does"""
+import os
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from rest_framework import serializers
+
+REQUEST_DURATION = Histogram(
+    "eshop_request_duration_seconds", "Request latency by view and action", ["view", "action", "method", "status"])
+DB_DURATION = Histogram(
+    "eshop_request_db_duration_seconds", "Time spent in database queries per request", ["view", "action"])
+SERIALIZER_DURATION = Histogram(
+    "eshop_serializer_duration_seconds", "Time spent building serializer representations", ["serializer"])
+CHECKOUTS = Counter("eshop_checkouts", "Checkouts by outcome", ["outcome"])
+CATALOG_CACHE_REQUESTS = Counter("eshop_catalog_cache_requests", "Catalog cache lookups by result", ["result"])
+
+
+def render_metrics() -> bytes:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def get_view_labels(view_func, method: str) -> tuple[str, str]:
+    """Returns the viewset and its action, or the view name for other views"""
+    if cls := getattr(view_func, "cls", None):
+        return cls.__name__, getattr(view_func, "actions", {}).get(method.lower(), method.lower())
+    return f"{view_func.__module__}.{view_func.__name__}", method.lower()
+
+
+class TimedSerializerMixin:
+    """Observes the time spent building the representation of a top level serializer"""
+
+    @property
+    def data(self):
+        with SERIALIZER_DURATION.labels(type(self).__name__).time():
+            return super().data  # type: ignore[misc]
+
+
+class TimedListSerializer(serializers.ListSerializer):
+    """Observes the time spent building the representation of a list, labelled by the child serializer"""
+
+    @property
+    def data(self):
+        with SERIALIZER_DURATION.labels(type(self.child).__name__).time():
+            return super().data
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from app.metrics import DB_DURATION, REQUEST_DURATION, get_view_labels
+from app.routers import pin_response, pinning
+
+logger = logging.getLogger("app.sql")
+
+query_observers: ContextVar[tuple] = ContextVar("query_observers", default=())
+
+SQL_INSTRUMENTATION_DEFAULTS = {
+    "ENABLED": True,
+    "SAMPLE_RATE": 1.0,
+    "SLOW_REQUEST_MS": 500,
+    "SLOW_QUERY_MS": 100,
+    "N_PLUS_ONE_THRESHOLD": 10,
+    "SERVER_TIMING": True,
+}
+
+
+def observe_queries(execute, sql, params, many, context):
+    """Execute wrapper, installed on every connection, reporting queries to the observers of the current request.
+    Context variables follow a request into sync_to_async threads, so queries of async views are observed too"""
+    if not (observers := query_observers.get()):
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started
+        for observer in observers:
+            observer.record(sql, duration)
+
+
+@contextmanager
+def observing_queries(observer):
+    token = query_observers.set(query_observers.get() + (observer,))
+    try:
+        yield
+    finally:
+        query_observers.reset(token)
+
+
+class QueryTimer:
+    """Query observer summing up the time spent in queries"""
+
+    def __init__(self):
+        self.duration = 0.0
+
+    def record(self, sql: str, duration: float):
+        self.duration += duration
+
+
+class QueryRecorder:
+    """Query observer collecting the number, duration and SQL of executed queries.
+    Django passes SQL with placeholders, so identical statements with different params share one shape"""
+
+    def __init__(self, slow_query_ms: float):
+        self.slow_query_ms = slow_query_ms
+        self.count = 0
+        self.duration = 0.0
+        self.shapes: Counter = Counter()
+        self.slow_queries: list[dict] = []
+
+    def record(self, sql: str, duration: float):
+        self.count += 1
+        self.duration += duration
+        self.shapes[sql] += 1
+        if duration * 1000 >= self.slow_query_ms:
+            self.slow_queries.append({"sql": sql, "ms": round(duration * 1000, 1)})
+
+    def repeated(self, threshold: int) -> list[dict]:
+        return [{"sql": sql, "count": count} for sql, count in self.shapes.most_common() if count >= threshold]
+
+
+class AsyncCapableMiddleware:
+    """Base of middleware running in the mode of the handler, so async views served under ASGI
+    never hop to a thread on account of it. Subclasses implement both `call` and `acall`"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # marks the instance as a coroutine function, like django.utils.deprecation.MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine  # type: ignore[attr-defined]
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.acall(request)
+        return self.call(request)
+
+    def call(self, request):
+        raise NotImplementedError
+
+    async def acall(self, request):
+        raise NotImplementedError
+
+
+class SQLInstrumentationMiddleware(AsyncCapableMiddleware):
+    """Counts and times the queries of a sampled share of requests, reports them in a Server-Timing header
+    and logs a summary of slow requests and requests repeating the same SQL (N+1).
+    Configured by the SQL_INSTRUMENTATION setting"""
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.config = {**SQL_INSTRUMENTATION_DEFAULTS, **getattr(settings, "SQL_INSTRUMENTATION", {})}
+        if not self.config["ENABLED"]:
+            raise MiddlewareNotUsed
+
+    def call(self, request):
+        if random.random() >= self.config["SAMPLE_RATE"]:
+            return self.get_response(request)
+        recorder = QueryRecorder(self.config["SLOW_QUERY_MS"])
+        started = time.perf_counter()
+        with observing_queries(recorder):
+            response = self.get_response(request)
+        self.finish(request, response, recorder, time.perf_counter() - started)
+        return response
+
+    async def acall(self, request):
+        if random.random() >= self.config["SAMPLE_RATE"]:
+            return await self.get_response(request)
+        recorder = QueryRecorder(self.config["SLOW_QUERY_MS"])
+        started = time.perf_counter()
+        with observing_queries(recorder):
+            response = await self.get_response(request)
+        self.finish(request, response, recorder, time.perf_counter() - started)
+        return response
+
+    def finish(self, request, response, recorder: QueryRecorder, total: float):
+        self.add_server_timing(response, recorder, total)
+        self.report(request, response, recorder, total)
+
+    def add_server_timing(self, response, recorder: QueryRecorder, total: float):
+        if self.config["SERVER_TIMING"]:
+            response["Server-Timing"] = f'db;dur={recorder.duration * 1000:.1f};desc="{recorder.count} queries", ' \
+                                        f'app;dur={total * 1000:.1f}'
+
+    def report(self, request, response, recorder: QueryRecorder, total: float):
+        repeated = recorder.repeated(self.config["N_PLUS_ONE_THRESHOLD"])
+        if total * 1000 < self.config["SLOW_REQUEST_MS"] and not repeated:
+            return
+        summary = {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "ms": round(total * 1000, 1),
+            "queries": recorder.count,
+            "db_ms": round(recorder.duration * 1000, 1),
+            "repeated": repeated,
+            "slow_queries": recorder.slow_queries,
+        }
+        logger.warning("SQL summary %s", json.dumps(summary), extra={"sql_summary": summary})
+
+
+class ReplicaPinMiddleware(AsyncCapableMiddleware):
+    """Keeps reads of a client on the primary database during the pin window after its last write,
+    opening the window on responses of requests that wrote. Not used without replicas, see app.routers"""
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed
+
+    def call(self, request):
+        with pinning(request) as pin:
+            response = self.get_response(request)
+        return pin_response(response) if pin.wrote else response
+
+    async def acall(self, request):
+        with pinning(request) as pin:
+            response = await self.get_response(request)
+        return pin_response(response) if pin.wrote else response
+
+
+class MetricsMiddleware(AsyncCapableMiddleware):
+    """Observes request latency and database time of every request, labelled by view and viewset action"""
+
+    def call(self, request):
+        timer = QueryTimer()
+        started = time.perf_counter()
+        with observing_queries(timer):
+            response = self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started, timer)
+        return response
+
+    async def acall(self, request):
+        timer = QueryTimer()
+        started = time.perf_counter()
+        with observing_queries(timer):
+            response = await self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started, timer)
+        return response
+
+    @staticmethod
+    def observe(request, response, duration: float, timer: QueryTimer):
+        # labels come from the resolved route, a process_view hook would cost async requests a thread hop
+        match = request.resolver_match
+        view, action = get_view_labels(match.func, request.method) if match else ("unresolved", request.method.lower())
+        REQUEST_DURATION.labels(view, action, request.method, response.status_code).observe(duration)
+        DB_DURATION.labels(view, action).observe(timer.duration)
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.5 on 2026-10-18 03:38
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+
+
+def merge_duplicate_cart_items(apps, schema_editor):
+    CartItem = apps.get_model('app', 'CartItem')
+    duplicates = CartItem.objects.values('user', 'product').annotate(
+        count=Count('id'), last=Max('id'), total=Sum('quantity')).filter(count__gt=1)
+    for duplicate in duplicates:
+        CartItem.objects.filter(pk=duplicate['last']).update(quantity=duplicate['total'])
+        CartItem.objects.filter(user=duplicate['user'], product=duplicate['product']) \
+            .exclude(pk=duplicate['last']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_product_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_cart_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('user', 'product'), name='cartitem_user_product_unique'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+import json
+import logging
+
+from django.db import migrations
+from django.db.models import Count, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+logger = logging.getLogger("app.migrations")
+
+
+def remove_duplicate_ratings(apps, schema_editor):
+    """Keeps the latest rating of a product by a user, ahead of the unique constraint of 0012_index_audit.
+    Every removed rating is logged with its content, and the aggregates of the affected products recalculated"""
+    Product = apps.get_model('app', 'Product')
+    ProductRating = apps.get_model('app', 'ProductRating')
+    duplicates = list(ProductRating.objects.values('user', 'product').annotate(
+        count=Count('id'), last=Max('id')).filter(count__gt=1))
+    removed = 0
+    for duplicate in duplicates:
+        ratings = ProductRating.objects.filter(user=duplicate['user'], product=duplicate['product']) \
+            .exclude(pk=duplicate['last'])
+        for rating in ratings.values('id', 'user', 'product', 'rating', 'comment'):
+            logger.warning("Removing duplicate product rating %s", json.dumps(rating))
+        removed += ratings.delete()[0]
+    if removed:
+        logger.warning("Removed %s duplicate product ratings of %s products", removed,
+                       len({duplicate['product'] for duplicate in duplicates}))
+    ratings = ProductRating.objects.filter(product=OuterRef('pk')).order_by().values('product')
+    Product.objects.filter(pk__in={duplicate['product'] for duplicate in duplicates}).update(
+        rating_count=Coalesce(Subquery(ratings.annotate(count=Count('id')).values('count')), 0),
+        rating_sum=Coalesce(Subquery(ratings.annotate(total=Sum('rating')).values('total')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_product_category_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_ratings, migrations.RunPython.noop),
+    ]
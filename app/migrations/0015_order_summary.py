@@ -0,0 +1,44 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import rest_framework.utils.encoders
+
+# summaries of orders placed before checkout wrote them
+FILL_ORDER_SUMMARIES = """
+UPDATE app_order SET item_count = summary.item_count, lines = summary.lines
+FROM (
+    SELECT item.order_id, sum(item.quantity) AS item_count,
+        jsonb_agg(jsonb_build_object('product', item.product_id, 'name', coalesce(product.name, ''),
+                                     'price', item.price, 'quantity', item.quantity) ORDER BY item.id) AS lines
+    FROM app_orderitem item LEFT JOIN app_product product ON product.id = item.product_id
+    GROUP BY item.order_id
+) summary
+WHERE app_order.id = summary.order_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='lines',
+            field=models.JSONField(default=list, encoder=rest_framework.utils.encoders.JSONEncoder),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='order',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='items', to='app.order'),
+        ),
+        migrations.RunSQL(FILL_ORDER_SUMMARIES, migrations.RunSQL.noop),
+    ]
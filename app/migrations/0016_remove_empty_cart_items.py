@@ -0,0 +1,29 @@
+import json
+import logging
+
+from django.db import migrations
+
+logger = logging.getLogger("app.migrations")
+
+
+def remove_empty_cart_items(apps, schema_editor):
+    """Removes cart items with a quantity below one, ahead of the check constraint of 0017_cartitem_quantity_positive.
+    Every removed cart item is logged with its content"""
+    CartItem = apps.get_model('app', 'CartItem')
+    items = CartItem.objects.filter(quantity__lt=1)
+    for item in items.values('id', 'user', 'product', 'quantity'):
+        logger.warning("Removing empty cart item %s", json.dumps(item))
+    removed = items.delete()[0]
+    if removed:
+        logger.warning("Removed %s empty cart items", removed)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_order_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_empty_cart_items, migrations.RunPython.noop),
+    ]
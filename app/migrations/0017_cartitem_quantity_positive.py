@@ -0,0 +1,22 @@
+# Generated by Django 4.1.13 on 2026-10-18 05:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_remove_empty_cart_items'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cartitem',
+            name='quantity',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.CheckConstraint(check=models.Q(('quantity__gte', 1)), name='cartitem_quantity_positive'),
+        ),
+    ]
@@ -1,9 +1,23 @@
 import uuid
+from typing import Iterable
 
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
+from django.db import connections, models, router
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, Upper
+from django.utils import timezone
 from django.utils.html import format_html
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def get_average_rating(count: int, total: int) -> float:
+    """Average rating from stored aggregates, rounded to one decimal place"""
+    if count:
+        return round(total / count, 1)
+    return 0
 
 
 class BaseInfo(models.Model):
@@ -14,6 +28,22 @@ class BaseInfo(models.Model):
         abstract = True
 
 
+class ProductQuerySet(models.QuerySet):
+
+    def adjust_rating(self, product_id: int, count: int, total: int) -> int:
+        """Shifts stored rating aggregates of a product by the given deltas"""
+        return self.filter(pk=product_id).update(
+            rating_count=F("rating_count") + count, rating_sum=F("rating_sum") + total, updated=timezone.now())
+
+    def rebuild_rating_aggregates(self) -> int:
+        """Recalculates stored rating aggregates from ratings with a single update"""
+        ratings = ProductRating.objects.filter(product=OuterRef("pk")).order_by().values("product")
+        return self.update(
+            rating_count=Coalesce(Subquery(ratings.annotate(count=Count("id")).values("count")), 0),
+            rating_sum=Coalesce(Subquery(ratings.annotate(total=Sum("rating")).values("total")), 0),
+        )
+
+
 class Product(BaseInfo):
     CATEGORIES = (
         ("face", "Face Skincare"),
@@ -22,19 +52,54 @@ class Product(BaseInfo):
         ("other", "Other")
     )
 
-    name = models.CharField(max_length=50, db_index=True)
+    # natural key of products loaded from supplier feeds, see app.imports
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    name = models.CharField(max_length=50)
     description = models.TextField(default="")
     image = models.ImageField(upload_to='products/', null=True)
+    # resized copies of image by variant name and format, see app.images
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     price = models.DecimalField(max_digits=6, decimal_places=2, default=0)
     stock = models.PositiveIntegerField(default=0)
     category = models.CharField(choices=CATEGORIES, max_length=11, default="other")
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.BigIntegerField(default=0, editable=False)
+    # maintained by a database trigger from name and description
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["created", "id"], name="product_created_id_idx"),
+            models.Index(fields=["updated"], name="product_updated_idx"),
+            models.Index(fields=["category", "price"], name="product_category_price_idx"),
+            models.Index(fields=["category", "created", "id"], name="product_category_created_idx"),
+            # the name filter is case insensitive, iexact compares UPPER(name)
+            models.Index(Upper("name"), name="product_name_upper_idx"),
+            GinIndex(fields=["search_vector"], name="product_search_vector_idx"),
+        ]
+
+    @property
+    def rating(self) -> float:
+        return get_average_rating(self.rating_count, self.rating_sum)
+
+    @property
+    def has_image_variants(self) -> bool:
+        return bool(self.image) and self.image_variants.get("source") == self.image.name
+
+    @property
+    def thumbnail_url(self) -> str:
+        if self.has_image_variants:
+            return self.image.storage.url(self.image_variants["thumbnail"]["jpeg"])
+        return self.image.url
 
     @property
     def thumbnail_preview(self):
         if self.image:
             image_dimensions = 100
             return format_html(
-                f"<img src='{self.image.url}' height='{image_dimensions}' width='{image_dimensions}'>")
+                f"<img src='{self.thumbnail_url}' height='{image_dimensions}' width='{image_dimensions}'>")
         return ""
 
     def __str__(self):
@@ -42,14 +107,21 @@ class Product(BaseInfo):
 
 
 class ProductRating(BaseInfo):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="product_ratings")
+    # indexed as the prefix of the unique constraint
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="product_ratings", db_index=False)
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="ratings")
     rating = models.IntegerField(validators=[MinValueValidator(1), MaxValueValidator(5)])
     comment = models.TextField()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "product"], name="productrating_user_product_unique"),
+        ]
+
 
 class Order(BaseInfo):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="orders")
+    # indexed as the prefix of order_user_created_id_idx
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="orders", db_index=False)
     ordered_items = models.ManyToManyField(Product, through="OrderItem")
     name = models.CharField(max_length=50, default="")
     email = models.EmailField(max_length=250, default="")
@@ -57,31 +129,135 @@ class Order(BaseInfo):
     total_amount = models.DecimalField(max_digits=6, decimal_places=2, null=True)
     paid = models.BooleanField(default=False)
     tracking_number = models.UUIDField(default=uuid.uuid4, editable=False)
+    # summary of the order items written at checkout, see get_order_summary
+    item_count = models.PositiveIntegerField(default=0)
+    lines = models.JSONField(default=list, encoder=JSONEncoder)
 
     class Meta:
         ordering = ["-created"]
+        indexes = [
+            models.Index(fields=["user", "-created", "-id"], name="order_user_created_id_idx"),
+        ]
 
     def __str__(self):
         return f"Order({self.id}, {self.total_amount}, {self.created})"
 
 
 class OrderItem(models.Model):
-    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    # indexed by the covering orderitem_order_covering_idx
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="items", db_index=False)
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True)
     price = models.DecimalField(max_digits=6, decimal_places=2, default=0)
     quantity = models.PositiveIntegerField(default=0)
     created = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # items of listed orders are read with index-only scans
+            models.Index(fields=["order"], include=["product", "price", "quantity"],
+                         name="orderitem_order_covering_idx"),
+        ]
+
     def __str__(self):
         return f"Ordered item: order ({self.order_id}, product {self.product_id})"
 
 
-class CartItem(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="cart")
+def get_order_summary(items: Iterable, names: dict[int, str]) -> dict:
+    """Item count and snapshot of the lines of an order, kept on the order so order lists read no other table.
+    Lines keep the product names as ordered, prices are encoded as the API renders them"""
+    lines = [{"product": item.product_id, "name": names.get(item.product_id, ""), "price": item.price,
+              "quantity": item.quantity} for item in items]
+    return {"item_count": sum(line["quantity"] for line in lines), "lines": lines}
+
+
+class CartItemQuerySet(models.QuerySet):
+
+    def add(self, user: User, product: Product, quantity: int) -> "CartItem":
+        """Inserts a cart item, or adds the quantity to the existing one, in a single statement"""
+        opts = self.model._meta
+        columns = [field.column for field in opts.concrete_fields]
+        sql = f"""
+            INSERT INTO {opts.db_table} (user_id, product_id, price, quantity, created, updated)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (user_id, product_id) DO UPDATE
+            SET quantity = {opts.db_table}.quantity + EXCLUDED.quantity, price = EXCLUDED.price,
+                updated = EXCLUDED.updated
+            RETURNING {", ".join(columns)}
+        """
+        now = timezone.now()
+        db = router.db_for_write(self.model)
+        with connections[db].cursor() as cursor:
+            cursor.execute(sql, [user.id, product.id, product.price, quantity, now, now])
+            cart_item = self.model.from_db(db, [field.attname for field in opts.concrete_fields], cursor.fetchone())
+        cart_item.user, cart_item.product = user, product
+        return cart_item
+
+
+class CartItem(BaseInfo):
+    # indexed as the prefix of the unique constraint
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="cart", db_index=False)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     price = models.DecimalField(max_digits=6, decimal_places=2, default=0)
-    quantity = models.IntegerField(default=0)
-    created = models.DateTimeField(auto_now_add=True)
+    quantity = models.IntegerField(default=1)
+
+    objects = CartItemQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "product"], name="cartitem_user_product_unique"),
+            models.CheckConstraint(check=models.Q(quantity__gte=1), name="cartitem_quantity_positive"),
+        ]
 
     def __str__(self):
         return f"Cart item: user ({self.user_id}, product {self.product_id})"
+
+
+class Job(BaseInfo):
+    """Background job, run by the workers of the run_workers command, see app.jobs"""
+    STATUSES = (
+        ("queued", "Queued"),
+        ("failed", "Failed")
+    )
+
+    # dotted path of the function the job calls with kwargs
+    task = models.CharField(max_length=200)
+    kwargs = models.JSONField(default=dict)
+    status = models.CharField(choices=STATUSES, max_length=6, default="queued")
+    run_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # workers claim queued jobs by run_at, failed jobs are left for inspection
+            models.Index(fields=["run_at"], condition=models.Q(status="queued"), name="job_queued_run_at_idx"),
+        ]
+
+    def __str__(self):
+        return f"Job {self.id}: {self.task}"
+
+
+class IdempotencyKey(models.Model):
+    """Response to a request sent with an Idempotency-Key header, replayed to retries of the request, see
+    app.idempotency"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="idempotency_keys", db_index=False)
+    key = models.CharField(max_length=255)
+    # hash of the method, path and body of the request, a key is never replayed to another request
+    fingerprint = models.CharField(max_length=32)
+    status_code = models.PositiveSmallIntegerField()
+    # JSON text, as jsonb would reorder keys of the replayed response
+    response = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "key"], name="idempotencykey_user_key_unique"),
+        ]
+        indexes = [
+            # expired keys are purged by creation time
+            models.Index(fields=["created"], name="idempotencykey_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"Idempotency key {self.key}: user {self.user_id}"
@@ -0,0 +1,14 @@
+"""Emails to customers, sent by background jobs, see app.jobs"""
+from django.core.mail import send_mail
+
+from app.models import Order
+
+
+def send_order_confirmation(order_id: int):
+    order = Order.objects.get(pk=order_id)
+    if not order.email:
+        return
+    send_mail(f"Order {order.id} confirmation",
+              f"Dear {order.name or 'customer'},\n\nwe have received your order {order.id} "
+              f"of {order.total_amount} and will let you know once it ships.",
+              None, [order.email])
@@ -0,0 +1,224 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict, namedtuple
+from functools import reduce
+from operator import or_
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import BooleanField, F, Field, Func, Q, QuerySet, Value
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from app.filters import get_category_facet_base, get_product_facets
+
+Cursor = namedtuple("Cursor", ["position", "reverse"])
+
+
+class KeysetPagination(CursorPagination):
+    """Cursor pagination over a unique ordering.
+    Pages are fetched by filtering on the values of the last seen row, so no OFFSET scans are ever issued.
+    A filter backend can override the ordering by providing `get_keyset_ordering`."""
+    ordering = ("created", "id")
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = "page_size"
+    count_query_param = "count"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        keyset = self.start_page(queryset, request, view)
+        self.count = self.get_approximate_count(queryset, request)
+        return self.set_page(list(keyset))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """paginate_queryset of async views, reading the page with the async ORM.
+        Counts are exact, as there is no async EXPLAIN for the planner's estimate"""
+        keyset = self.start_page(queryset, request, view)
+        self.count = await queryset.order_by().acount() if self.count_requested(request) else None
+        return self.set_page([row async for row in keyset.aiterator()])
+
+    def start_page(self, queryset, request, view) -> QuerySet:
+        """Reads the page params and returns the query of the page with one extra row"""
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request, queryset)
+        return self.get_keyset_queryset(queryset)[:self.page_size + 1]
+
+    def set_page(self, rows: list) -> list:
+        self.page = rows[:self.page_size]
+        self.has_next, self.has_previous = len(rows) > self.page_size, self.cursor.position is not None
+        if self.cursor.reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = self.has_previous, self.has_next
+        return self.page
+
+    def get_ordering(self, request, queryset, view):
+        for backend in getattr(view, "filter_backends", ()):
+            if ordering := getattr(backend(), "get_keyset_ordering", lambda *args: None)(request, queryset, view):
+                return tuple(ordering)
+        return tuple(self.ordering)
+
+    def get_keyset_queryset(self, queryset: QuerySet) -> QuerySet:
+        ordering = [invert(field) for field in self.ordering] if self.cursor.reverse else self.ordering
+        if self.cursor.position is not None:
+            queryset = queryset.filter(keyset_filter(ordering, self.cursor.position))
+        return queryset.order_by(*ordering)
+
+    def get_approximate_count(self, queryset: QuerySet, request) -> int | None:
+        if not self.count_requested(request):
+            return None
+        return estimate_count(queryset)
+
+    def count_requested(self, request) -> bool:
+        return request.query_params.get(self.count_query_param) in ("1", "true")
+
+    def decode_cursor(self, request, queryset: QuerySet) -> Cursor:
+        try:
+            return self.parse_cursor(request.query_params.get(self.cursor_query_param), queryset)
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def parse_cursor(self, encoded: str | None, queryset: QuerySet) -> Cursor:
+        """Decodes a cursor, converting its position values with the fields of the ordering"""
+        if encoded is None:
+            return Cursor(position=None, reverse=False)
+        position, reverse = json.loads(urlsafe_b64decode(encoded.encode("ascii")))
+        if len(position) != len(self.ordering):
+            raise ValueError("Cursor position does not match the ordering")
+        fields = [get_ordering_field(queryset, name.lstrip("-")) for name in self.ordering]
+        return Cursor(position=[field.to_python(value) for field, value in zip(fields, position)],
+                      reverse=bool(reverse))
+
+    def encode_cursor(self, cursor: Cursor) -> str:
+        encoded = urlsafe_b64encode(json.dumps([cursor.position, int(cursor.reverse)], default=str).encode())
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded.decode("ascii"))
+
+    def get_position(self, instance) -> list:
+        if isinstance(instance, dict):
+            return [instance[field.lstrip("-")] for field in self.ordering]
+        return [getattr(instance, field.lstrip("-")) for field in self.ordering]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(Cursor(position=self.get_position(self.page[-1]), reverse=False))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(Cursor(position=self.get_position(self.page[0]), reverse=True))
+
+    def get_paginated_response(self, data):
+        response = OrderedDict(next=self.get_next_link(), previous=self.get_previous_link())
+        if self.count is not None:
+            response["count"] = self.count
+        response["results"] = data
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema["properties"]["count"] = {"type": "integer", "example": 123}
+        return response_schema
+
+
+class ProductPagination(KeysetPagination):
+    """Also returns facet counts of the filtered products with `?facets=1`, see get_product_facets"""
+    ordering = ("created", "id")
+    max_page_size = 100
+    facets_query_param = "facets"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.facets = None
+        if self.facets_requested(request):
+            self.facets = get_product_facets(queryset, get_category_facet_base(request, view))
+        return super().paginate_queryset(queryset, request, view)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        self.facets = None
+        if self.facets_requested(request):
+            # Django 4.1 has no async aggregate, the facet query runs in a thread
+            base = get_category_facet_base(request, view)
+            self.facets = await sync_to_async(get_product_facets)(queryset, base)
+        return await super().apaginate_queryset(queryset, request, view)
+
+    def facets_requested(self, request) -> bool:
+        return request.query_params.get(self.facets_query_param) in ("1", "true")
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.facets is not None:
+            response.data["facets"] = self.facets
+        return response
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema["properties"]["facets"] = {"type": "object"}
+        return response_schema
+
+
+class OrderPagination(KeysetPagination):
+    ordering = ("-created", "-id")
+    max_page_size = 50
+
+
+def invert(field: str) -> str:
+    return field[1:] if field.startswith("-") else f"-{field}"
+
+
+def get_ordering_field(queryset: QuerySet, name: str) -> Field:
+    """The model field or annotation output field an ordering name refers to"""
+    if name in queryset.query.annotations:
+        return queryset.query.annotations[name].output_field
+    return queryset.model._meta.get_field(name)
+
+
+class Row(Func):
+    """Row value `(a, b, ...)` of expressions"""
+    template = "(%(expressions)s)"
+    output_field = Field()
+
+
+class RowComparison(Func):
+    """Compares two rows by their first unequal items, as `(a, b) > (x, y)`"""
+    template = "%(expressions)s"
+    output_field = BooleanField()
+
+    def __init__(self, left: Row, operator: str, right: Row):
+        super().__init__(left, right)
+        self.arg_joiner = f" {operator} "
+
+
+def keyset_filter(ordering: list | tuple, position: list) -> Q | RowComparison:
+    """Builds `(a, b) > (x, y)` for rows placed after the given position in the ordering, which an index of the
+    ordering serves as a single range. Mixed directions, as `(-a, b)`, cannot be compared as rows"""
+    if len({field.startswith("-") for field in ordering}) > 1:
+        return mixed_keyset_filter(ordering, position)
+    names = [field.lstrip("-") for field in ordering]
+    return RowComparison(Row(*map(F, names)), "<" if ordering[0].startswith("-") else ">", Row(*map(Value, position)))
+
+
+def mixed_keyset_filter(ordering: list | tuple, position: list) -> Q:
+    """Builds `(a > x) OR (a = x AND b < y) ...` for rows placed after the given position in the ordering"""
+    conditions = []
+    for index, field in enumerate(ordering):
+        name, lookup = (field[1:], "lt") if field.startswith("-") else (field, "gt")
+        equal = {ordering[i].lstrip("-"): position[i] for i in range(index)}
+        conditions.append(Q(**equal, **{f"{name}__{lookup}": position[index]}))
+    return reduce(or_, conditions)
+
+
+def estimate_count(queryset: QuerySet) -> int:
+    """Returns the planner's row estimate on Postgres instead of counting the rows"""
+    if connections[queryset.db].vendor != "postgresql":
+        return queryset.count()
+    plan = json.loads(queryset.order_by().explain(format="json"))
+    return int(plan[0]["Plan"]["Plan Rows"])
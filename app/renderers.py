@@ -0,0 +1,57 @@
+"""JSON renderer and parser backed by orjson, selected by the JSON_BACKEND setting.
+Without orjson installed, or with JSON_BACKEND = "json", they behave as the stdlib based ones of DRF"""
+from django.conf import settings
+from rest_framework import renderers
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+# datetimes are passed to the DRF encoder, which writes UTC as "Z" unlike orjson
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+def use_orjson() -> bool:
+    return orjson is not None and getattr(settings, "JSON_BACKEND", "orjson") == "orjson"
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    """Renders with orjson, falling back to DRF for indented output. Types orjson does not know, Decimal among them,
+    are converted by the DRF encoder, so the output stays byte-identical"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        orjson_enabled = data is not None and use_orjson()
+        if orjson_enabled and not self.get_indent(accepted_media_type, renderer_context or {}):
+            if (content := self.dumps(data)) is not None:
+                return content
+        return super().render(data, accepted_media_type, renderer_context)
+
+    @staticmethod
+    def dumps(data) -> bytes | None:
+        try:
+            content = orjson.dumps(data, default=JSONEncoder().default, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            # integers beyond 64 bits among others, the stdlib renders or rejects them as before
+            return None
+        # like DRF, escape the line and paragraph separators valid in JSON but not in javascript strings
+        return content.replace(b"\xe2\x80\xa8", b"\\u2028").replace(b"\xe2\x80\xa9", b"\\u2029")
+
+
+class FastJSONParser(JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if not use_orjson():
+            return super().parse(stream, media_type, parser_context)
+        return loads(stream.read())
+
+
+def loads(content: bytes):
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError as exc:
+        raise ParseError(f"JSON parse error - {exc}")
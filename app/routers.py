@@ -0,0 +1,83 @@
+"""Routing of reads to the replicas listed in the DATABASE_REPLICAS setting.
+Writes, reads within a transaction and reads of a client that wrote within DATABASE_REPLICA_PIN_SECONDS
+go to the primary, so clients read their own writes despite replication lag"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = "db_pin"
+
+
+class PrimaryPin:
+    """Routing state of a request, pinned to the primary until `pinned_until` or once it wrote"""
+
+    def __init__(self, pinned_until: float):
+        self.pinned_until = pinned_until
+        self.wrote = False
+
+    @property
+    def active(self) -> bool:
+        return self.wrote or time.time() < self.pinned_until
+
+
+request_pin: ContextVar[PrimaryPin | None] = ContextVar("request_pin", default=None)
+
+
+def get_pinned_until(request) -> float:
+    """Returns the end of the pin window recorded in the cookie of a client that wrote"""
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0))
+    except ValueError:
+        return 0
+
+
+@contextmanager
+def pinning(request):
+    """Routes the queries of a request by its pin, which the router marks on the first write"""
+    pin = PrimaryPin(get_pinned_until(request))
+    token = request_pin.set(pin)
+    try:
+        yield pin
+    finally:
+        request_pin.reset(token)
+
+
+def pin_response(response):
+    """Opens the pin window of the client"""
+    seconds = settings.DATABASE_REPLICA_PIN_SECONDS
+    response.set_cookie(PIN_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True, samesite="Lax")
+    return response
+
+
+def reads_primary() -> bool:
+    pin = request_pin.get()
+    return connections[DEFAULT_DB_ALIAS].in_atomic_block or pin is not None and pin.active
+
+
+class ReplicaRouter:
+    """Sends reads to a random replica and writes to the primary. Objects read from a database
+    fetch their relations from the same one"""
+
+    def db_for_read(self, model, **hints):
+        if (instance := hints.get("instance")) is not None and instance._state.db:
+            return instance._state.db
+        if not settings.DATABASE_REPLICAS or reads_primary():
+            return DEFAULT_DB_ALIAS
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        if (pin := request_pin.get()) is not None:
+            pin.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        return obj1._state.db in databases and obj2._state.db in databases or None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema by replication
+        return False if db in settings.DATABASE_REPLICAS else None
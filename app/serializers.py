@@ -1,9 +1,35 @@
+from abc import ABC, abstractmethod
+from collections import Counter
+from decimal import Decimal
+from typing import Callable, Iterable
+
 from django.contrib.auth.models import User
-from django.db import transaction
-from django.db.models import Sum, F
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
 from rest_framework import serializers
 
-from app.models import Product, ProductRating, CartItem, Order, OrderItem
+from app.carts import ROW_FIELDS, get_cart_store
+from app.jobs import enqueue
+from app.metrics import CHECKOUTS, SERIALIZER_DURATION, TimedListSerializer, TimedSerializerMixin
+from app.models import Product, ProductRating, CartItem, Order, OrderItem, get_average_rating, \
+    get_order_summary
+from app.notifications import send_order_confirmation
+
+
+def get_variant_urls(image: str | None, variants: dict, build_url: Callable[[str], str]) -> dict:
+    """Urls of resized images by variant name and format, none when the variants are not of the current image"""
+    if not image or variants.get("source") != image:
+        return {}
+    storage = Product._meta.get_field("image").storage
+    return {name: {image_format: build_url(storage.url(path)) for image_format, path in formats.items()}
+            for name, formats in variants.items() if name != "source"}
+
+
+def reject_duplicate(error: IntegrityError, constraint: str, message: str):
+    """Raises a validation error in place of a violation of the named unique constraint"""
+    if getattr(getattr(error.__cause__, "diag", None), "constraint_name", None) == constraint:
+        raise serializers.ValidationError(message) from error
 
 
 class RatingMixin(serializers.Serializer):
@@ -16,9 +42,7 @@ class RatingMixin(serializers.Serializer):
 
     @staticmethod
     def get_rating(obj: Product) -> float:
-        if rating_count := obj.ratings.count():
-            return round(obj.ratings.aggregate(Sum("rating"))["rating__sum"] / rating_count, 1)
-        return 0
+        return obj.rating
 
 
 class InStockMixin(serializers.Serializer):
@@ -33,15 +57,40 @@ class InStockMixin(serializers.Serializer):
         return obj.stock > 0
 
 
-class ProductSerializer(RatingMixin, InStockMixin, serializers.ModelSerializer):
+class ImageVariantsMixin(serializers.Serializer):
+    """A mixin for exposing urls of resized product images by variant name and format"""
+    image_variants = serializers.SerializerMethodField()
+
+    class Meta:
+        fields = ["image_variants"]
+
+    def get_image_variants(self, obj: Product) -> dict:
+        return get_variant_urls(obj.image.name, obj.image_variants, self.build_url)
+
+    def build_url(self, url: str) -> str:
+        if request := self.context.get("request"):
+            return request.build_absolute_uri(url)
+        return url
+
+
+class ProductSerializer(TimedSerializerMixin, RatingMixin, InStockMixin, ImageVariantsMixin,
+                        serializers.ModelSerializer):
 
     class Meta:
         model = Product
+        list_serializer_class = TimedListSerializer
         fields = ["id", "name", "image", "price", "stock", "in_stock",
-                  "category"] + RatingMixin.Meta.fields + InStockMixin.Meta.fields
+                  "category"] + RatingMixin.Meta.fields + InStockMixin.Meta.fields + ImageVariantsMixin.Meta.fields
+
 
+class ProductExportParamsSerializer(serializers.Serializer):
+    """Query params of the catalog export"""
+    output = serializers.ChoiceField(choices=["ndjson", "csv"], default="ndjson")
+    compression = serializers.ChoiceField(choices=["gzip"], required=False)
+    updated_since = serializers.DateTimeField(required=False)
 
-class ProductRatingSerializer(serializers.ModelSerializer):
+
+class ProductRatingSerializer(TimedSerializerMixin, serializers.ModelSerializer):
 
     class Meta:
         model = ProductRating
@@ -55,21 +104,33 @@ class ProductRatingSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Product already has been rated!")
         return data
 
+    def create(self, validated_data):
+        # a concurrent rating of the same product passes validate, the unique constraint rejects it
+        try:
+            with transaction.atomic():
+                return super().create(validated_data)
+        except IntegrityError as error:
+            reject_duplicate(error, "productrating_user_product_unique", "Product already has been rated!")
+            raise
+
 
-class ProductInfoSerializer(RatingMixin, InStockMixin, serializers.ModelSerializer):
+class ProductInfoSerializer(TimedSerializerMixin, RatingMixin, InStockMixin, ImageVariantsMixin,
+                            serializers.ModelSerializer):
     ratings = ProductRatingSerializer(many=True)
 
     class Meta:
         model = Product
         fields = ["id", "name", "image", "price", "description", "stock", "in_stock",
-                  "ratings"] + RatingMixin.Meta.fields + InStockMixin.Meta.fields
+                  "ratings"] + RatingMixin.Meta.fields + InStockMixin.Meta.fields + ImageVariantsMixin.Meta.fields
 
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = CartItem
+        list_serializer_class = TimedListSerializer
         fields = ["user", "product", "price", "quantity"]
         read_only_fields = ["price", "user"]
+        extra_kwargs = {"quantity": {"min_value": 1}}
 
     def to_representation(self, instance: Product) -> dict:
         data = super().to_representation(instance)
@@ -79,16 +140,9 @@ class CartItemSerializer(serializers.ModelSerializer):
         }
         return data
 
-    @transaction.atomic
     def create(self, validated_data):
-        cart_item = CartItem.objects.filter(user=self.context["request"].user, product=validated_data["product"],
-                                            quantity__gte=1)
-        if cart_item.exists():
-            validated_data["quantity"] += cart_item[0].quantity
-            cart_item.delete()
-        validated_data["price"] = validated_data["product"].price
-        validated_data["user"] = self.context["request"].user
-        return super().create(validated_data)
+        return get_cart_store().add(self.context["request"].user, validated_data["product"],
+                                    validated_data["quantity"])
 
 
 class OrderItemSerializer(serializers.ModelSerializer):
@@ -98,44 +152,131 @@ class OrderItemSerializer(serializers.ModelSerializer):
         fields = ["product", "price", "quantity"]
 
 
-class OrderSerializer(serializers.ModelSerializer):
-    order_items = OrderItemSerializer(many=True, read_only=True)
+class OrderSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """Order with the summary of its lines kept on the order row, so listing orders reads no other table"""
 
     class Meta:
         model = Order
-        fields = ["id", "user", "name", "email", "address", "total_amount", "created", "paid", "ordered_items",
-                  "order_items"]
-        read_only_fields = ["total_amount", "user", "name", "email", "address", "created"]
+        list_serializer_class = TimedListSerializer
+        fields = ["id", "user", "name", "email", "address", "total_amount", "created", "paid", "item_count", "lines"]
+        read_only_fields = ["total_amount", "user", "name", "email", "address", "created", "item_count", "lines"]
 
     def validate(self, data):
         data["user"] = self.context["request"].user
         return data
 
     @staticmethod
-    def get_total_amount(user: User) -> float:
-        total_amount = CartItem.objects.filter(user=user).aggregate(
-            total_amount=Sum(F("price") * F("quantity")))["total_amount"]
-        return total_amount
+    def get_total_amount(cart_items: list[CartItem]) -> Decimal:
+        return sum((item.price * item.quantity for item in cart_items), Decimal(0))
 
     @transaction.atomic
     def create(self, validated_data):
-        cart_items = CartItem.objects.filter(user=validated_data["user"])
-        validated_data["total_amount"] = self.get_total_amount(validated_data["user"])
+        cart_store = get_cart_store()
+        cart_items = cart_store.get_items(validated_data["user"])
+        if not cart_items:
+            CHECKOUTS.labels("empty_cart").inc()
+            raise serializers.ValidationError({"cart": ["Cart is empty"]})
+        validated_data["total_amount"] = self.get_total_amount(cart_items)
+        names = Product.objects.filter(pk__in=[item.product_id for item in cart_items]).values_list("pk", "name")
+        validated_data.update(get_order_summary(cart_items, dict(names)))
         validated_data["name"] = validated_data["user"].first_name
         validated_data["email"] = validated_data["user"].email
         order = super().create(validated_data)
-        for item in cart_items:
-            OrderItem.objects.create(
-                order=order,
-                product=item.product,
-                price=item.price,
-                quantity=item.quantity,
-            )
-            item.delete()
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, product_id=item.product_id, price=item.price, quantity=item.quantity)
+            for item in cart_items
+        )
+        cart_store.remove(validated_data["user"], cart_items)
+        # reserved last, so row locks of popular products are held only until the commit
+        self.reserve_stock(cart_items)
+        # side effects run as jobs, committed with the order, instead of stretching the checkout
+        enqueue(send_order_confirmation, order_id=order.id)
+        transaction.on_commit(CHECKOUTS.labels("success").inc)
         return order
 
+    @staticmethod
+    def reserve_stock(cart_items: list[CartItem]):
+        """Locks ordered products in id order, so concurrent checkouts can not deadlock,
+        and takes ordered quantities off the stock without letting it go below zero"""
+        quantities: Counter = Counter()
+        for item in cart_items:
+            quantities[item.product_id] += item.quantity
+        locked = Product.objects.select_for_update().filter(pk__in=quantities).order_by("pk")
+        stock = dict(locked.values_list("pk", "stock"))
+        if sold_out := sorted(pk for pk, quantity in quantities.items() if stock.get(pk, 0) < quantity):
+            CHECKOUTS.labels("out_of_stock").inc()
+            raise serializers.ValidationError({"stock": [f"Not enough products in stock: {sold_out}"]})
+        ordered = Case(*(When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()))
+        Product.objects.filter(pk__in=quantities, stock__gte=ordered).update(
+            stock=F("stock") - ordered, updated=timezone.now())
+
+
+class OrderDetailSerializer(OrderSerializer):
+    """Order expanded to its order item rows"""
+    items = OrderItemSerializer(many=True, read_only=True)
+
+    class Meta(OrderSerializer.Meta):
+        fields = OrderSerializer.Meta.fields + ["items"]
+
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ("id", "name", "email", "address", "orders")
+
+
+class RowSerializer(ABC):
+    """Read-only serializer of `.values()` rows for hot list endpoints.
+    A single function builds each item, skipping field introspection and method field lookups of DRF serializers.
+    Output has to stay identical to the serializer the endpoint uses otherwise"""
+    fields: list[str] = []
+
+    def __init__(self, context: dict):
+        self.context = context
+
+    def serialize(self, rows: Iterable[dict]) -> list[dict]:
+        with SERIALIZER_DURATION.labels(type(self).__name__).time():
+            to_representation = self.to_representation
+            return [to_representation(row) for row in rows]
+
+    @abstractmethod
+    def to_representation(self, row: dict) -> dict:
+        """Builds the item of a row"""
+
+
+class ProductRowSerializer(RowSerializer):
+    """Rows of ProductSerializer"""
+    fields = ["id", "name", "image", "price", "stock", "category", "rating_count", "rating_sum", "image_variants"]
+
+    def __init__(self, context: dict):
+        super().__init__(context)
+        request = context.get("request")
+        self.build_url = request.build_absolute_uri if request else str
+        self.image_url = Product._meta.get_field("image").storage.url
+
+    def to_representation(self, row: dict) -> dict:
+        image = row["image"]
+        return {
+            "id": row["id"],
+            "name": row["name"],
+            "image": self.build_url(self.image_url(image)) if image else None,
+            "price": row["price"],
+            "stock": row["stock"],
+            "in_stock": row["stock"] > 0,
+            "category": row["category"],
+            "rating": get_average_rating(row["rating_count"], row["rating_sum"]),
+            "image_variants": get_variant_urls(image, row["image_variants"], self.build_url),
+        }
+
+
+class CartItemRowSerializer(RowSerializer):
+    """Rows of CartItemSerializer"""
+    fields = ROW_FIELDS
+
+    def to_representation(self, row: dict) -> dict:
+        return {
+            "user": row["user"],
+            "product": {"id": row["product"], "name": row["product__name"]},
+            "price": row["price"],
+            "quantity": row["quantity"],
+        }
@@ -0,0 +1,54 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+from app.cache import bump_catalog_version
+from app.carts import get_cart_store
+from app.images import schedule_product_variants
+from app.middleware import observe_queries
+from app.models import Product, ProductRating
+
+
+@receiver(pre_save, sender=ProductRating)
+def remember_previous_rating(sender, instance: ProductRating, **kwargs):
+    """Keeps the stored rating of an updated instance, so aggregates can be shifted by the difference"""
+    previous = ProductRating.objects.filter(pk=instance.pk).values("product_id", "rating")
+    instance._previous = None if instance._state.adding else previous.first()
+
+
+@receiver(post_save, sender=ProductRating)
+def add_rating_to_product(sender, instance: ProductRating, **kwargs):
+    if previous := getattr(instance, "_previous", None):
+        Product.objects.adjust_rating(previous["product_id"], -1, -previous["rating"])
+    Product.objects.adjust_rating(instance.product_id, 1, instance.rating)
+
+
+@receiver(post_delete, sender=ProductRating)
+def remove_rating_from_product(sender, instance: ProductRating, **kwargs):
+    Product.objects.adjust_rating(instance.product_id, -1, -instance.rating)
+
+
+@receiver(post_save, sender=Product)
+def generate_image_variants(sender, instance: Product, **kwargs):
+    if instance.image and not instance.has_image_variants:
+        # queued in the transaction saving the product, workers see the job once it commits
+        schedule_product_variants(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductRating)
+def invalidate_catalog_cache(sender, **kwargs):
+    bump_catalog_version()
+
+
+@receiver(connection_created)
+def install_query_observer(sender, connection, **kwargs):
+    if observe_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(observe_queries)
+
+
+@receiver(setting_changed)
+def reset_cart_store(sender, setting: str, **kwargs):
+    if setting == "CART_STORE":
+        get_cart_store.cache_clear()
@@ -1,10 +1,67 @@
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from base64 import urlsafe_b64encode
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from importlib import import_module
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import sync_to_async
+
+from django.apps import apps
 from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.files.storage import default_storage
+from django.core import mail
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.conf import settings
+from django.db import Error, IntegrityError, connection, connections, router, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from model_bakery import baker
+from PIL import Image
+from prometheus_client import REGISTRY
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.exceptions import ParseError, ValidationError
+from rest_framework.filters import BaseFilterBackend
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase, APITransactionTestCase
 
-from app.models import Product, ProductRating, Order, CartItem
+from app.benchmarks import ENDPOINTS, HANDLER_ENDPOINTS, benchmark_handlers, benchmark_rendering, \
+    benchmark_serialization, find_query_growth, make_orders, run_benchmarks, seed_catalog, serve_request
+from app.cache import CATALOG_VERSION_KEY, get_catalog_cache, get_catalog_version
+from app.carts import get_cart_store, redis
+from app.db.base import DatabaseWrapper, close_pools
+from app.exports import EXPORT_COLUMNS
+from app.filters import trigram_available
+from app.idempotency import REPLAYED_HEADER
+from app.images import update_product_variants
+from app.jobs import MAX_RETRY_DELAY, RETRY_DELAY, enqueue, get_retry_delay, run_next_job, work
+from app.imports import import_products
+from app.middleware import ReplicaPinMiddleware, SQLInstrumentationMiddleware
+from app.models import Product, ProductRating, Order, OrderItem, CartItem, Job, IdempotencyKey
+from app.pagination import ProductPagination, keyset_filter
+from app.renderers import FastJSONParser, FastJSONRenderer
+from app.routers import PIN_COOKIE
+from app.serializers import CartItemRowSerializer, CartItemSerializer, ProductRatingSerializer, ProductRowSerializer, \
+    ProductSerializer
+from app.views import ProductViewSet
 
 
 class ProductGetTests(APITestCase):
@@ -18,7 +75,7 @@ class ProductGetTests(APITestCase):
     def test_get_products_response(self):
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 3)
+        self.assertEqual(len(response.data["results"]), 3)
         self.assertIsInstance(response.data, object)
 
     def test_get_product_detail(self):
@@ -36,29 +93,653 @@ class ProductGetTests(APITestCase):
     def test_get_filter_category(self):
         response = self.client.get(reverse("product-list"), {"category": "other"})
         self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
-        self.assertEqual(len(response.data), 3)
+        self.assertEqual(len(response.data["results"]), 3)
 
     def test_get_filter_category_not_found(self):
         response = self.client.get(reverse("product-list"), {"category": "hair"})
         self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data["results"]), 0)
 
     def test_get_filter_name(self):
         response = self.client.get(reverse("product-list"), {"name": self.product[0].name})
         self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data["results"]), 1)
 
     def test_get_search_name(self):
         response = self.client.get(reverse("product-list"), {"search": self.product[0].name[:3]})
         self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data["results"]), 1)
 
     def test_ratings(self):
         product_2 = baker.make(Product)
         baker.make(ProductRating, product=product_2, rating=5)
         baker.make(ProductRating, product=product_2, rating=3)
         response = self.client.get(reverse("product-list"))
-        self.assertEqual(response.data[-1]["rating"], 4)
+        self.assertEqual(response.data["results"][-1]["rating"], 4)
+
+    def test_get_products_query_count_does_not_depend_on_ratings(self):
+        baker.make(ProductRating, product=self.product[0], _quantity=3)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class ProductRatingAggregateTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.product = baker.make(Product)
+        self.user = baker.make(User)
+
+    def _refresh(self):
+        self.product.refresh_from_db()
+        return self.product.rating_count, self.product.rating_sum
+
+    def test_rating_create_through_api_updates_aggregates(self):
+        baker.make(ProductRating, product=self.product, rating=2)
+        self.client.force_authenticate(self.user)
+        data = {"product": self.product.id, "rating": 5, "comment": "Nice"}
+        response = self.client.post(reverse("rating-list"), data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self._refresh(), (2, 7))
+        self.assertEqual(self.product.rating, 3.5)
+
+    def test_rating_update_shifts_aggregates(self):
+        other_product = baker.make(Product)
+        rating = baker.make(ProductRating, product=self.product, rating=2)
+        rating.rating = 4
+        rating.save()
+        self.assertEqual(self._refresh(), (1, 4))
+        rating.product = other_product
+        rating.save()
+        self.assertEqual(self._refresh(), (0, 0))
+        other_product.refresh_from_db()
+        self.assertEqual((other_product.rating_count, other_product.rating_sum), (1, 4))
+
+    def test_rating_delete_updates_aggregates(self):
+        ratings = baker.make(ProductRating, product=self.product, rating=3, _quantity=3)
+        ratings[0].delete()
+        ProductRating.objects.filter(pk=ratings[1].pk).delete()
+        self.assertEqual(self._refresh(), (1, 3))
+
+    def test_rebuild_ratings_command(self):
+        baker.make(ProductRating, product=self.product, rating=4, _quantity=2)
+        empty_product = baker.make(Product)
+        Product.objects.update(rating_count=10, rating_sum=10)
+        call_command("rebuild_ratings", stdout=StringIO())
+        self.assertEqual(self._refresh(), (2, 8))
+        empty_product.refresh_from_db()
+        self.assertEqual(empty_product.rating, 0)
+
+
+class ProductSearchTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cream = baker.make(Product, name="Hydrating cream", description="Rich texture for dry skin")
+        self.serum = baker.make(Product, name="Vitamin serum", description="Lighter than a hydrating cream")
+        self.shampoo = baker.make(Product, name="Shampoo", description="Gentle daily wash")
+        self.url = reverse("product-list")
+
+    def _search(self, term, **params):
+        response = self.client.get(self.url, {"search": term, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        return [product["id"] for product in response.data["results"]]
+
+    def test_search_name_and_description_ranked(self):
+        self.assertEqual(self._search("hydrating cream"), [self.cream.id, self.serum.id])
+        self.assertEqual(self._search("gentle"), [self.shampoo.id])
+
+    def test_search_prefix(self):
+        self.assertEqual(self._search("sham"), [self.shampoo.id])
+
+    def test_search_hyphenated_term(self):
+        serum = baker.make(Product, name="Anti-aging serum", description="Firming")
+        self.assertEqual(self._search("anti-aging"), [serum.id])
+        self.assertEqual(self._search("aging serum"), [serum.id])
+
+    def test_search_is_a_single_query(self):
+        get_catalog_cache().clear()
+        with CaptureQueriesContext(connection) as plain:
+            self.client.get(self.url)
+        with CaptureQueriesContext(connection) as searched:
+            self.client.get(self.url, {"search": "shampooo"})
+        self.assertEqual(len(searched), len(plain))
+
+    def test_search_ignores_query_syntax(self):
+        self.assertEqual(self._search("cream) | & !:*"), [self.cream.id, self.serum.id])
+
+    def test_search_vector_follows_updates(self):
+        self.shampoo.description = "Cream wash"
+        self.shampoo.save()
+        self.assertIn(self.shampoo.id, self._search("cream"))
+
+    def test_search_pages_by_rank(self):
+        first_page = self.client.get(self.url, {"search": "cream", "page_size": 1})
+        second_page = self.client.get(first_page.data["next"])
+        self.assertEqual(first_page.data["results"][0]["id"], self.cream.id)
+        self.assertEqual(second_page.data["results"][0]["id"], self.serum.id)
+        self.assertIsNone(second_page.data["next"])
+
+    def test_search_typo_falls_back_to_trigram(self):
+        if not trigram_available(connection.alias):
+            self.skipTest("pg_trgm extension is not available")
+        self.assertEqual(self._search("shampooo"), [self.shampoo.id])
+
+    def test_search_without_match(self):
+        self.assertEqual(self._search("zzzzqqqq"), [])
+
+
+class ProductCacheTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        get_catalog_cache().clear()
+        self.product = baker.make(Product, name="Cream", stock=3)
+        self.url = reverse("product-list")
+        self.detail_url = reverse("product-detail", kwargs={"pk": self.product.id})
+
+    def test_cache_hit_does_not_query_database(self):
+        response = self.client.get(self.url)
+        self.client.get(self.detail_url)
+        with self.assertNumQueries(0):
+            cached_response = self.client.get(self.url)
+            self.client.get(self.detail_url)
+        self.assertEqual(cached_response.data, response.data)
+        self.assertEqual(cached_response["ETag"], response["ETag"])
+
+    def test_conditional_request(self):
+        etag = self.client.get(self.detail_url)["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+    def _expire_entries(self):
+        version = get_catalog_version()
+        get_catalog_cache().clear()
+        get_catalog_cache().set(CATALOG_VERSION_KEY, version, timeout=None)
+
+    def test_etag_survives_cache_refill(self):
+        etag = self.client.get(self.detail_url)["ETag"]
+        self._expire_entries()
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_etag_changes_with_content_of_refill(self):
+        etag = self.client.get(self.detail_url)["ETag"]
+        # as checkouts take stock, without bumping the catalog version
+        Product.objects.filter(pk=self.product.pk).update(stock=0)
+        self._expire_entries()
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data["in_stock"])
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_query_params_are_part_of_the_key(self):
+        self.client.get(self.url)
+        response = self.client.get(self.url, {"category": "hair"})
+        self.assertEqual(response.data["results"], [])
+
+    def test_product_change_invalidates_cache(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.product.name = "Serum"
+        self.product.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"][0]["name"], "Serum")
+
+    def test_rating_change_invalidates_cache(self):
+        self.client.get(self.detail_url)
+        baker.make(ProductRating, product=self.product, rating=4)
+        response = self.client.get(self.detail_url)
+        self.assertEqual(response.data["rating"], 4)
+        self.assertEqual(len(response.data["ratings"]), 1)
+
+    def test_missing_product_is_not_cached(self):
+        url = reverse("product-detail", kwargs={"pk": 0})
+        self.client.get(url)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ProductExportTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("product-export")
+        self.products = baker.make(Product, name="Cream", category="face", stock=2, _quantity=5)
+        baker.make(ProductRating, product=self.products[0], rating=4)
+        baker.make(ProductRating, product=self.products[0], rating=5)
+        self.products[1].stock = 0
+        self.products[1].save()
+
+    def _content(self, response) -> bytes:
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content)
+
+    def test_ndjson(self):
+        with mock.patch("app.exports.EXPORT_CHUNK_SIZE", 2):
+            response = self.client.get(self.url)
+            with CaptureQueriesContext(connection) as queries:
+                rows = [json.loads(line) for line in self._content(response).splitlines()]
+        self.assertTrue(queries, "rows are read while the response is streamed")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual([row["id"] for row in rows], [product.id for product in self.products])
+        self.assertEqual((rows[0]["rating"], rows[0]["rating_count"], rows[0]["in_stock"]), (4.5, 2, True))
+        self.assertFalse(rows[1]["in_stock"])
+
+    def test_ndjson_values_match_the_api(self):
+        Product.objects.filter(id=self.products[0].id).update(price=Decimal("10.50"))
+        row = json.loads(self._content(self.client.get(self.url)).splitlines()[0])
+        product = json.loads(self.client.get(reverse("product-detail", kwargs={"pk": row["id"]})).content)
+        self.assertEqual(row["price"], 10.5)
+        self.assertEqual((row["price"], row["rating"]), (product["price"], product["rating"]))
+
+    def test_csv(self):
+        response = self.client.get(self.url, {"output": "csv", "category": "hair"})
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="products.csv"')
+        self.assertEqual(self._content(response).decode().splitlines(), [",".join(EXPORT_COLUMNS)])
+
+    def test_gzip(self):
+        response = self.client.get(self.url, {"output": "csv", "compression": "gzip"})
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        rows = list(csv.DictReader(gzip.decompress(self._content(response)).decode().splitlines()))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]["rating"], "4.5")
+
+    def test_updated_since(self):
+        since = timezone.now()
+        baker.make(ProductRating, product=self.products[2], rating=3)
+        self.products[3].name = "Serum"
+        self.products[3].save()
+        response = self.client.get(self.url, {"updated_since": since.isoformat()})
+        rows = [json.loads(line) for line in self._content(response).splitlines()]
+        self.assertEqual([row["id"] for row in rows], [self.products[2].id, self.products[3].id])
+
+    def test_invalid_params(self):
+        response = self.client.get(self.url, {"output": "xml", "updated_since": "yesterday"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data), {"output", "updated_since"})
+
+
+class ProductImportTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.existing = baker.make(Product, sku="CR-1", name="Cream", price=10, stock=1, category="face")
+
+    def _write(self, name: str, content: str) -> str:
+        path = f"{self.directory}/{name}"
+        with (gzip.open if name.endswith(".gz") else open)(path, "wt") as feed:
+            feed.write(content)
+        return path
+
+    def _import(self, path: str, *args) -> str:
+        stdout = StringIO()
+        call_command("import_products", path, *args, stdout=stdout, stderr=StringIO())
+        return stdout.getvalue()
+
+    def test_csv_import(self):
+        path = self._write("feed.csv", "sku,name,price,stock,category\n"
+                                       "CR-1,Rich cream,12.50,4,face\n"
+                                       "SH-1,Shampoo,8,,hair\n"
+                                       ",No sku,1,1,face\n"
+                                       "SE-1,Serum,cheap,1,lips\n")
+        rejects = f"{self.directory}/rejects.ndjson"
+        with mock.patch("app.imports.bump_catalog_version") as bump_catalog_version:
+            output = self._import(path, "--rejects", rejects)
+        bump_catalog_version.assert_called_once_with()
+        self.assertIn("1 products created, 1 updated, 0 unchanged, 2 rows rejected", output)
+        self.assertRegex(output, r"Imported 2 rows at \d+ rows/s")
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.name, self.existing.price, self.existing.stock), ("Rich cream", 12.5, 4))
+        shampoo = Product.objects.get(sku="SH-1")
+        self.assertEqual((shampoo.stock, shampoo.category, shampoo.description, shampoo.rating), (0, "hair", "", 0))
+        with open(rejects) as rejects_file:
+            rejected = [json.loads(line) for line in rejects_file]
+        self.assertEqual([(row["row"], sorted(row["errors"])) for row in rejected],
+                         [(3, ["sku"]), (4, ["category", "price"])])
+
+    def test_ndjson_import(self):
+        updated = self.existing.updated
+        lines = [{"sku": "CR-1", "name": "Cream", "price": "10.00", "stock": 1, "category": "face"},
+                 {"sku": "BL-1", "name": "Lotion", "price": 5, "category": "body"},
+                 {"sku": "BL-1", "name": "Body lotion", "price": 6, "category": "body"}]
+        path = self._write("feed.ndjson.gz", "\n".join(map(json.dumps, lines)) + "\n{broken\n")
+        output = self._import(path, "--chunk-size", "2")
+        self.assertIn("1 products created, 0 updated, 2 unchanged, 1 rows rejected", output)
+        self.assertIn("2 rows processed", output)
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.updated, updated)
+        self.assertEqual(Product.objects.get(sku="BL-1").name, "Body lotion")
+        self.assertEqual(Product.objects.filter(search_vector="lotion").count(), 1)
+
+    def test_export_can_be_imported(self):
+        path = self._write("products.csv", b"".join(self.client.get(reverse("product-export"),
+                                                                    {"output": "csv"}).streaming_content).decode())
+        self.assertIn("0 products created, 0 updated, 1 unchanged, 0 rows rejected", self._import(path))
+
+    def test_throughput(self):
+        rows = ({"sku": f"SKU-{number}", "name": f"Product {number}", "price": "9.90", "stock": "3", "category": "body"}
+                for number in range(20000))
+        stats = import_products(rows, on_reject=mock.Mock(), on_progress=mock.Mock())
+        self.assertEqual((stats.loaded, stats.inserted, stats.rejected), (20000, 20000, 0))
+        self.assertEqual(Product.objects.filter(sku__startswith="SKU-").count(), 20000)
+
+    def test_unknown_format(self):
+        with self.assertRaisesMessage(CommandError, "Unknown feed format"):
+            self._import(self._write("feed.xml", ""))
+
+
+class RowSerializerTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.context = {"request": Request(APIRequestFactory().get("/products/"))}
+        variants = {"source": "products/cream.png", "thumbnail": {"jpeg": "products/variants/a-thumbnail.jpg",
+                                                                  "webp": "products/variants/a-thumbnail.webp"}}
+        self.products = [
+            baker.make(Product, name="Cream", image="products/cream.png", image_variants=variants, price="9.90",
+                       stock=2, rating_count=3, rating_sum=13),
+            baker.make(Product, name="Serum", image="products/serum.png", image_variants=variants, stock=0),
+            baker.make(Product, name="Soap", image="", price=1, stock=7, category="body"),
+        ]
+        self.user = baker.make(User)
+        for product in self.products:
+            CartItem.objects.add(self.user, product, 2)
+
+    def _render(self, data) -> bytes:
+        return JSONRenderer().render(data)
+
+    def test_product_rows_match_serializer(self):
+        queryset = Product.objects.order_by("id")
+        expected = self._render(ProductSerializer(queryset, many=True, context=self.context).data)
+        rows = ProductRowSerializer(self.context).serialize(queryset.values(*ProductRowSerializer.fields))
+        self.assertEqual(self._render(rows), expected)
+
+    def test_cart_item_rows_match_serializer(self):
+        queryset = CartItem.objects.select_related("product").order_by("id")
+        expected = self._render(CartItemSerializer(queryset, many=True, context=self.context).data)
+        rows = CartItemRowSerializer(self.context).serialize(queryset.values(*CartItemRowSerializer.fields))
+        self.assertEqual(self._render(rows), expected)
+
+    def test_list_endpoints_use_rows(self):
+        self.client.force_authenticate(self.user)
+        for url in (reverse("product-list"), reverse("cart-list")):
+            with mock.patch.object(ProductSerializer, "to_representation", side_effect=AssertionError), \
+                    mock.patch.object(CartItemSerializer, "to_representation", side_effect=AssertionError):
+                response = self.client.get(url, {"search": "cream"} if "products" in url else {})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class AsyncProductTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        get_catalog_cache().clear()
+        self.product = baker.make(Product, name="Hydrating cream", category="face", stock=3)
+        baker.make(Product, name="Shampoo", category="hair", _quantity=2)
+        baker.make(ProductRating, product=self.product, rating=4)
+        self.url = reverse("async-product-list")
+        self.detail_url = reverse("async-product-detail", kwargs={"pk": self.product.id})
+
+    async def _get_sync(self, url, data=None):
+        return (await sync_to_async(self.client.get)(url, data)).json()
+
+    async def test_list_matches_sync_view(self):
+        for params in ({"page_size": 2, "count": 1}, {"search": "cream"}, {"category": "hair", "facets": 1}):
+            expected = await self._get_sync(reverse("product-list"), params)
+            response = await self.async_client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.json()["results"], expected["results"])
+            self.assertEqual(response.json().get("facets"), expected.get("facets"))
+        self.assertIn("db;dur=", response["Server-Timing"])
+        self.assertNotIn('"0 queries"', response["Server-Timing"])
+
+    async def test_pages_follow_the_cursor(self):
+        first_page = (await self.async_client.get(self.url, {"page_size": 2})).json()
+        second_page = (await self.async_client.get(first_page["next"])).json()
+        self.assertEqual(len(second_page["results"]), 1)
+        self.assertIsNone(second_page["next"])
+
+    async def test_detail_matches_sync_view(self):
+        expected = await self._get_sync(reverse("product-detail", kwargs={"pk": self.product.id}))
+        response = await self.async_client.get(self.detail_url)
+        self.assertEqual(response.json(), expected)
+        self.assertEqual(len(response.json()["ratings"]), 1)
+
+    async def test_cache_hit_does_not_query_database(self):
+        response = await self.async_client.get(self.url, {"search": "cream"})
+        with mock.patch("app.views.get_async_product_data", side_effect=AssertionError):
+            cached_response = await self.async_client.get(self.url, {"search": "cream"})
+        self.assertEqual(cached_response.json(), response.json())
+        self.assertEqual(cached_response["ETag"], response["ETag"])
+
+    async def test_conditional_request(self):
+        etag = (await self.async_client.get(self.detail_url))["ETag"]
+        # the async client of Django 4.1 sends extra arguments as plain header names
+        response = await self.async_client.get(self.detail_url, **{"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    async def test_errors(self):
+        missing = await self.async_client.get(reverse("async-product-detail", kwargs={"pk": self.product.id + 10}))
+        self.assertEqual(missing.status_code, status.HTTP_404_NOT_FOUND)
+        invalid_cursor = await self.async_client.get(self.url, {"cursor": "invalid"})
+        self.assertEqual(invalid_cursor.status_code, status.HTTP_404_NOT_FOUND)
+        invalid_filter = await self.async_client.get(self.url, {"category": "shoes"})
+        self.assertEqual(invalid_filter.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("category", invalid_filter.json())
+
+    async def test_only_get_is_allowed(self):
+        response = await self.async_client.post(self.url)
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+class ProductImageVariantsTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.product = baker.make(Product, image=self._make_image())
+
+    @staticmethod
+    def _make_image(size=(1600, 900)):
+        buffer = BytesIO()
+        Image.new("RGB", size, "teal").save(buffer, format="PNG")
+        return SimpleUploadedFile("cream.png", buffer.getvalue(), content_type="image/png")
+
+    def test_variants_generated(self):
+        self.assertTrue(update_product_variants(self.product.id))
+        self.product.refresh_from_db()
+        self.assertTrue(self.product.has_image_variants)
+        thumbnail = self.product.image_variants["thumbnail"]
+        with Image.open(default_storage.path(thumbnail["webp"])) as image:
+            self.assertEqual((image.format, image.size), ("WEBP", (200, 200)))
+        with Image.open(default_storage.path(self.product.image_variants["small"]["jpeg"])) as image:
+            self.assertEqual((image.format, image.size), ("JPEG", (400, 225)))
+        self.assertIn(thumbnail["jpeg"], self.product.thumbnail_preview)
+        self.assertFalse(update_product_variants(self.product.id))
+
+    def test_variants_generated_by_job_off_request_path(self):
+        product = baker.make(Product, image=self._make_image())
+        self.assertEqual(list(Job.objects.values_list("task", "kwargs")),
+                         [("app.images.update_product_variants", {"product_id": self.product.id}),
+                          ("app.images.update_product_variants", {"product_id": product.id})])
+        self.assertFalse(Product.objects.get(pk=product.id).has_image_variants)
+        run_workers()
+        self.assertTrue(Product.objects.get(pk=product.id).has_image_variants)
+
+    def test_serializer_exposes_variant_urls(self):
+        response = self.client.get(reverse("product-detail", kwargs={"pk": self.product.id}))
+        self.assertEqual(response.data["image_variants"], {})
+        update_product_variants(self.product.id)
+        response = self.client.get(reverse("product-detail", kwargs={"pk": self.product.id}))
+        self.assertEqual(set(response.data["image_variants"]), {"thumbnail", "small", "large"})
+        self.assertTrue(response.data["image_variants"]["large"]["webp"].startswith("http://testserver/media/"))
+
+    def test_generate_image_variants_command(self):
+        baker.make(Product, image=None)
+        call_command("generate_image_variants", stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertTrue(self.product.has_image_variants)
+
+
+class ProductPaginationTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.products = baker.make(Product, _quantity=5)
+        self.url = reverse("product-list")
+
+    def _walk(self, url, data=None):
+        ids = []
+        while url:
+            response = self.client.get(url, data)
+            ids += [product["id"] for product in response.data["results"]]
+            url, data = response.data["next"], None
+        return ids
+
+    def test_cursor_walks_all_products_in_order(self):
+        with CaptureQueriesContext(connection) as queries:
+            ids = self._walk(self.url, {"page_size": 2})
+        self.assertEqual(ids, [product.id for product in self.products])
+        self.assertFalse(any("OFFSET" in query["sql"] for query in queries.captured_queries))
+
+    def test_cursor_with_equal_created_values(self):
+        Product.objects.update(created=timezone.now())
+        self.assertEqual(self._walk(self.url, {"page_size": 2}), sorted(product.id for product in self.products))
+
+    def test_cursor_compares_rows(self):
+        first_page = self.client.get(self.url, {"page_size": 2})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(first_page.data["next"])
+        sql = "\n".join(query["sql"] for query in queries.captured_queries)
+        self.assertIn('WHERE ("app_product"."created", "app_product"."id") > (', sql)
+        self.assertNotIn(" OR ", sql)
+
+    def test_mixed_directions_are_compared_by_field(self):
+        product = self.products[2]
+        after = Product.objects.filter(keyset_filter(("-stock", "id"), [product.stock, product.id]))
+        self.assertIn(" OR ", str(after.query))
+        self.assertEqual(set(after), {other for other in self.products
+                                      if (-other.stock, other.id) > (-product.stock, product.id)})
+
+    def test_previous_page(self):
+        first_page = self.client.get(self.url, {"page_size": 2})
+        second_page = self.client.get(first_page.data["next"])
+        response = self.client.get(second_page.data["previous"])
+        self.assertEqual(response.data["results"], first_page.data["results"])
+        self.assertIsNone(response.data["previous"])
+        self.assertIsNotNone(response.data["next"])
+
+    def test_page_size_is_capped(self):
+        with mock.patch.object(ProductPagination, "max_page_size", 3):
+            response = self.client.get(self.url, {"page_size": 100})
+        self.assertEqual(len(response.data["results"]), 3)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {"cursor": "invalid"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cursor_of_wrong_types(self):
+        cursor = urlsafe_b64encode(json.dumps([["garbage", 1], 0]).encode()).decode()
+        for params in ({}, {"search": "cream"}):
+            response = self.client.get(self.url, {"cursor": cursor, **params})
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_approximate_count(self):
+        response = self.client.get(self.url, {"count": 1})
+        self.assertIsInstance(response.data["count"], int)
+        self.assertNotIn("count", self.client.get(self.url).data)
+
+
+class ProductFacetsTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        get_catalog_cache().clear()
+        self.url = reverse("product-list")
+        baker.make(Product, name="Day cream", category="face", price=8, stock=3)
+        baker.make(Product, name="Night cream", category="face", price=30, stock=0)
+        baker.make(Product, name="Body cream", category="body", price=120, stock=1)
+        baker.make(Product, name="Shampoo", category="hair", price=10, stock=5)
+
+    def test_facets(self):
+        with CaptureQueriesContext(connection) as plain:
+            self.client.get(self.url, {"page_size": 2})
+        with CaptureQueriesContext(connection) as faceted:
+            response = self.client.get(self.url, {"page_size": 2, "facets": 1})
+        self.assertEqual(len(faceted), len(plain) + 1)
+        self.assertEqual(len(response.data["results"]), 2)
+        facets = response.data["facets"]
+        self.assertEqual(facets["category"], {"face": 2, "body": 1, "hair": 1, "other": 0})
+        self.assertEqual(facets["stock"], {"in_stock": 3, "out_of_stock": 1})
+        self.assertEqual([bucket["count"] for bucket in facets["price"]], [1, 1, 1, 0, 1])
+        self.assertEqual((facets["price"][-1]["min"], facets["price"][-1]["max"]), (100, None))
+
+    def test_facets_of_filtered_products(self):
+        response = self.client.get(self.url, {"search": "cream", "max_price": 100, "facets": "true"})
+        self.assertEqual([product["name"] for product in response.data["results"]], ["Day cream", "Night cream"])
+        self.assertEqual(response.data["facets"]["category"], {"face": 2, "body": 0, "hair": 0, "other": 0})
+
+    def test_facets_of_selected_category(self):
+        response = self.client.get(self.url, {"category": "face", "max_price": 100, "facets": 1})
+        self.assertEqual({product["name"] for product in response.data["results"]}, {"Day cream", "Night cream"})
+        facets = response.data["facets"]
+        self.assertEqual(facets["category"], {"face": 2, "body": 0, "hair": 1, "other": 0})
+        self.assertEqual(facets["stock"], {"in_stock": 1, "out_of_stock": 1})
+        self.assertEqual([bucket["count"] for bucket in facets["price"]], [1, 0, 1, 0, 0])
+
+    def test_facets_of_selected_category_apply_view_filter_backends(self):
+        class InStockFilter(BaseFilterBackend):
+            def filter_queryset(self, request, queryset, view):
+                return queryset.filter(stock__gt=0)
+
+        backends = (*ProductViewSet.filter_backends, InStockFilter)
+        with mock.patch.object(ProductViewSet, "filter_backends", backends):
+            response = self.client.get(self.url, {"category": "face", "facets": 1})
+        self.assertEqual([product["name"] for product in response.data["results"]], ["Day cream"])
+        self.assertEqual(response.data["facets"]["category"], {"face": 1, "body": 1, "hair": 1, "other": 0})
+
+    def test_facets_are_cached_until_product_change(self):
+        self.client.get(self.url, {"facets": 1})
+        with self.assertNumQueries(0):
+            self.client.get(self.url, {"facets": 1})
+        baker.make(Product, category="other")
+        response = self.client.get(self.url, {"facets": 1})
+        self.assertEqual(response.data["facets"]["category"]["other"], 1)
+
+    def test_without_facets(self):
+        self.assertNotIn("facets", self.client.get(self.url).data)
+
+
+class DuplicateRatingsMigrationTests(APITestCase):
+
+    def test_duplicates_are_removed_and_logged(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE app_productrating DROP CONSTRAINT productrating_user_product_unique")
+        user, product = baker.make(User), baker.make(Product)
+        first = ProductRating.objects.create(user=user, product=product, rating=1, comment="Bad")
+        latest = ProductRating.objects.create(user=user, product=product, rating=5, comment="Good")
+        other = baker.make(ProductRating, product=product, rating=3)
+        migration = import_module("app.migrations.0012_remove_duplicate_ratings")
+        with self.assertLogs("app.migrations", "WARNING") as logs:
+            migration.remove_duplicate_ratings(apps, None)
+        self.assertEqual(set(ProductRating.objects.values_list("id", flat=True)), {latest.id, other.id})
+        self.assertIn(f'"id": {first.id}', logs.output[0])
+        self.assertIn('"comment": "Bad"', logs.output[0])
+        self.assertIn("Removed 1 duplicate product ratings of 1 products", logs.output[1])
+        product.refresh_from_db()
+        self.assertEqual((product.rating_count, product.rating_sum), (2, 8))
 
 
 class ProductRatingPostTests(APITestCase):
@@ -90,6 +771,19 @@ class ProductRatingPostTests(APITestCase):
         self.assertEqual(ProductRating.objects.count(), 2)
         self.assertEqual(response.data["user"], self.user.id)
 
+    def test_concurrent_duplicate_rating_is_rejected(self):
+        # saved by a concurrent request after this one passed validate
+        baker.make(ProductRating, user=self.user, product=self.product, rating=3)
+        with self.assertRaises(ValidationError) as raised:
+            ProductRatingSerializer().create({"user": self.user, "product": self.product, "rating": 5, "comment": "!"})
+        self.assertEqual(raised.exception.detail, ["Product already has been rated!"])
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_sum), (1, 3))
+
+    def test_other_integrity_errors_are_raised(self):
+        with self.assertRaises(IntegrityError):
+            ProductRatingSerializer().create({"user": None, "product": self.product, "rating": 5, "comment": "!"})
+
     def test_unauthorized_product_rating_create(self):
         data = self._get_data()
         response = self.client.post(self.url, data)
@@ -136,10 +830,105 @@ class OrdersGetTests(APITestCase):
         response = self.client.get(self.url)
         orders_count = Order.objects.count()
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data[0]["user"], self.user.id)
-        self.assertEqual(len(response.data), 3)
+        self.assertEqual(response.data["results"][0]["user"], self.user.id)
+        self.assertEqual(len(response.data["results"]), 3)
         self.assertEqual(orders_count, 4)
 
+    def test_get_user_orders_newest_first(self):
+        self.client.force_authenticate(self.user)
+        Order.objects.filter(pk=self.order[0].pk).update(created=timezone.now() + timedelta(days=1))
+        first_page = self.client.get(self.url, {"page_size": 2})
+        second_page = self.client.get(first_page.data["next"])
+        ids = [order["id"] for order in first_page.data["results"] + second_page.data["results"]]
+        self.assertEqual(ids, [self.order[0].id, self.order[2].id, self.order[1].id])
+        self.assertIsNone(second_page.data["next"])
+
+    def _list_queries(self, orders: int) -> int:
+        user = baker.make(User)
+        make_orders(user, baker.make(Product, _quantity=orders), Decimal(10))
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.data["results"]), orders)
+        return len(queries)
+
+    def test_order_list_reads_order_rows_alone(self):
+        self.assertEqual(self._list_queries(1), self._list_queries(20))
+        self.assertEqual(self._list_queries(1), 2)
+
+    def test_order_list_serializes_summary(self):
+        product = baker.make(Product, name="Cream")
+        order = make_orders(self.user, [product], Decimal("10.90"))[0]
+        product_id = product.id
+        product.delete()
+        self.client.force_authenticate(self.user)
+        listed = self.client.get(self.url).data["results"][0]
+        self.assertNotIn("ordered_items", listed)
+        self.assertNotIn("items", listed)
+        self.assertEqual((listed["id"], listed["item_count"]), (order.id, 3))
+        self.assertEqual(listed["lines"], [{"product": product_id, "name": "Cream", "price": 10.9, "quantity": 3}])
+
+    def test_order_detail_expands_items(self):
+        product = baker.make(Product)
+        order = make_orders(self.user, [product], Decimal(10))[0]
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse("order-detail", kwargs={"pk": order.id}))
+        self.assertEqual(response.data["items"], [{"product": product.id, "price": 10, "quantity": 3}])
+        self.assertEqual(response.data["item_count"], 3)
+
+
+class ConditionalGetTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = baker.make(User)
+        self.orders = baker.make(Order, user=self.user, _quantity=2)
+        self.client.force_authenticate(self.user)
+
+    def test_orders_not_modified(self):
+        url = reverse("order-list")
+        etag = self.client.get(url)["ETag"]
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_orders_modified(self):
+        url = reverse("order-list")
+        etag = self.client.get(url)["ETag"]
+        self.orders[0].paid = True
+        self.orders[0].save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+        etag = self.client.get(url)["ETag"]
+        baker.make(Order, user=self.user)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_order_detail_if_modified_since(self):
+        url = reverse("order-detail", kwargs={"pk": self.orders[0].id})
+        last_modified = self.client.get(url)["Last-Modified"]
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        Order.objects.filter(pk=self.orders[0].id).update(updated=timezone.now() + timedelta(minutes=1))
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_etag_is_not_shared_between_users(self):
+        url = reverse("order-list")
+        etag = self.client.get(url)["ETag"]
+        other_user = baker.make(User)
+        Order.objects.filter(user=self.user).update(user=other_user)
+        self.client.force_authenticate(other_user)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_cart_modified_by_add_to_cart(self):
+        url = reverse("cart-list")
+        product = baker.make(Product)
+        CartItem.objects.add(self.user, product, 1)
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        CartItem.objects.add(self.user, product, 1)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
 
 class OrderPostTests(APITestCase):
     def setUp(self):
@@ -148,7 +937,7 @@ class OrderPostTests(APITestCase):
         password = "some_password"  # noqa: S105
         self.user.set_password(password)
         self.user.save()
-        self.product = baker.make(Product)
+        self.product = baker.make(Product, stock=5)
         self.cartitems = baker.make(CartItem, product=self.product, price=10, quantity=2, user=self.user)
 
         self.url = reverse("order-list")
@@ -167,7 +956,10 @@ class OrderPostTests(APITestCase):
         self.assertEqual(response.data["user"], self.user.id)
         self.assertEqual(response.data["email"], self.user.email)
         self.assertEqual(response.data["name"], self.user.first_name)
-        self.assertEqual(len(response.data["ordered_items"]), 1)
+        self.assertEqual(response.data["item_count"], 2)
+        self.assertEqual(response.data["lines"], [
+            {"product": self.product.id, "name": self.product.name, "price": Decimal(10), "quantity": 2}])
+        self.assertEqual(response.data["items"], [{"product": self.product.id, "price": 10, "quantity": 2}])
         self.assertEqual(response.data["total_amount"], 20.00)
         self.assertEqual(CartItem.objects.count(), 0)
 
@@ -176,6 +968,657 @@ class OrderPostTests(APITestCase):
         response = self.client.post(self.url, data)
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
+    def test_order_items_copied_from_cart(self):
+        baker.make(CartItem, price=5, quantity=3, user=self.user, product__stock=3)
+        self.client.force_authenticate(self.user)
+        response = self.client.post(self.url, self._get_data())
+        order = Order.objects.get(pk=response.data["id"])
+        self.assertEqual(order.total_amount, 35)
+        self.assertEqual(
+            sorted(order.items.values_list("price", "quantity")), [(5, 3), (10, 2)])
+        self.assertEqual(order.item_count, 5)
+        self.assertEqual(sorted((line["price"], line["quantity"]) for line in order.lines), [(5, 3), (10, 2)])
+
+    def test_order_create_reserves_stock(self):
+        self.client.force_authenticate(self.user)
+        self.client.post(self.url, self._get_data())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+
+    def test_order_create_out_of_stock(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=1)
+        self.client.force_authenticate(self.user)
+        response = self.client.post(self.url, self._get_data())
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(str(self.product.id), response.data["stock"][0])
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 0)
+        self.assertEqual(CartItem.objects.filter(user=self.user).count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 1)
+
+    def test_order_create_with_empty_cart(self):
+        CartItem.objects.filter(user=self.user).delete()
+        self.client.force_authenticate(self.user)
+        response = self.client.post(self.url, self._get_data())
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["cart"], ["Cart is empty"])
+        self.assertFalse(Order.objects.exists())
+
+
+class IdempotentOrderTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = baker.make(User)
+        self.product = baker.make(Product, stock=5)
+        baker.make(CartItem, user=self.user, product=self.product, price=10, quantity=2)
+        self.client.force_authenticate(self.user)
+        self.url = reverse("order-list")
+
+    def _post(self, key="checkout-1", data=None):
+        return self.client.post(self.url, data or {"paid": True}, HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_response(self):
+        first = self._post()
+        with CaptureQueriesContext(connection) as queries:
+            retry = self._post()
+        tables = [Order._meta.db_table, CartItem._meta.db_table, Product._meta.db_table]
+        self.assertFalse([query["sql"] for query in queries.captured_queries
+                          if any(f'"{table}"' in query["sql"] for table in tables)])
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((retry.status_code, retry.content), (first.status_code, first.content))
+        self.assertEqual(retry[REPLAYED_HEADER], "true")
+        self.assertFalse(first.has_header(REPLAYED_HEADER))
+        self.assertEqual(Order.objects.count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+
+    def test_other_key_checks_out_again(self):
+        self._post()
+        response = self._post("checkout-2")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["cart"], ["Cart is empty"])
+
+    def test_keys_are_not_shared_between_users(self):
+        self._post()
+        other_user = baker.make(User)
+        baker.make(CartItem, user=other_user, product=self.product, price=10, quantity=1)
+        self.client.force_authenticate(other_user)
+        response = self._post()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["user"], other_user.id)
+
+    def test_key_reused_for_other_request(self):
+        self._post()
+        response = self._post(data={"paid": False})
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_failed_request_is_not_stored(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=1)
+        self.assertEqual(self._post().status_code, status.HTTP_400_BAD_REQUEST)
+        Product.objects.filter(pk=self.product.pk).update(stock=2)
+        self.assertEqual(self._post().status_code, status.HTTP_201_CREATED)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, status.HTTP_201_CREATED)
+
+    def test_expired_key_runs_again(self):
+        first = self._post()
+        IdempotencyKey.objects.update(created=timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL + 1))
+        baker.make(CartItem, user=self.user, product=self.product, price=10, quantity=1)
+        response = self._post()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotEqual(response.data["id"], first.data["id"])
+        self.assertEqual(json.loads(IdempotencyKey.objects.get().response)["id"], response.data["id"])
+
+    def test_invalid_key(self):
+        self.assertEqual(self._post("x" * 256).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Order.objects.exists())
+
+    def test_purge_expired_keys(self):
+        self._post()
+        self._post("checkout-2")
+        IdempotencyKey.objects.update(created=timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL + 1))
+        baker.make(CartItem, user=self.user, product=self.product, price=10, quantity=1)
+        self._post("checkout-3")
+        out = StringIO()
+        call_command("purge_idempotency_keys", stdout=out)
+        self.assertIn("Purged 1 expired idempotency keys", out.getvalue())
+        self.assertEqual(list(IdempotencyKey.objects.values_list("key", flat=True)), ["checkout-3"])
+
+
+class OrderCheckoutQueryCountTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse("order-list")
+
+    def _checkout_queries(self, cart_size):
+        user = baker.make(User)
+        baker.make(CartItem, user=user, price=1, quantity=1, product__stock=1, _quantity=cart_size)
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, {"paid": True})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["total_amount"], cart_size)
+        return len(queries)
+
+    def test_checkout_query_count_does_not_grow_with_cart_size(self):
+        self.assertEqual(self._checkout_queries(1), self._checkout_queries(50))
+
+
+class QueryPlanTests(APITestCase):
+    """Explains the statements of every benchmarked endpoint with the default planner settings, over a catalog
+    of other shoppers large enough for index scans to pay off, so a sequential scan means no index suits the query"""
+    large_tables = {"app_product", "app_productrating", "app_order", "app_orderitem", "app_cartitem", "auth_user"}
+
+    def _seq_scans(self, plan: dict) -> list[str]:
+        scans = [plan["Relation Name"]] if plan["Node Type"] == "Seq Scan" else []
+        return scans + [scan for child in plan.get("Plans", []) for scan in self._seq_scans(child)]
+
+    def _explain(self, sql: str) -> list[str]:
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+            plan = cursor.fetchone()[0]
+        return [table for table in self._seq_scans(plan[0]["Plan"]) if table in self.large_tables]
+
+    @staticmethod
+    def _seed_other_shoppers():
+        products = baker.make(Product, name="Shampoo", description="Gentle wash", category="hair", _quantity=10000,
+                              _bulk_create=True)
+        for user in baker.make(User, _quantity=200, _bulk_create=True):
+            CartItem.objects.bulk_create(
+                CartItem(user=user, product=product, price=product.price, quantity=1) for product in products[:20])
+            make_orders(user, products[:20], Decimal(10))
+        with connection.cursor() as cursor:
+            # statistics and the GIN pending list as autovacuum would leave them
+            cursor.execute("ANALYZE")
+            cursor.execute("SELECT gin_clean_pending_list('product_search_vector_idx')")
+
+    def test_endpoints_do_not_scan_large_tables(self):
+        seed = seed_catalog(200)
+        self._seed_other_shoppers()
+        self.client.force_authenticate(seed["user"])
+        for endpoint in ENDPOINTS:
+            get_catalog_cache().clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = getattr(self.client, endpoint.method)(
+                    endpoint.url(seed), endpoint.data(seed) if endpoint.data else None)
+            self.assertLess(response.status_code, 400, endpoint.name)
+            statements = [query["sql"] for query in queries.captured_queries
+                          if query["sql"].startswith(("SELECT", "UPDATE", "DELETE"))]
+            self.assertTrue(statements, endpoint.name)
+            for sql in statements:
+                with self.subTest(endpoint=endpoint.name, sql=sql):
+                    self.assertEqual(self._explain(sql), [])
+
+
+class DatabaseConnectionTests(APITestCase):
+    """Serves requests through standalone connections of the test database, as the request handlers do"""
+
+    def setUp(self):
+        self.addCleanup(close_pools)
+
+    def get_database(self, **settings) -> DatabaseWrapper:
+        database = DatabaseWrapper({**connection.settings_dict, **settings}, alias=connection.alias)
+        self.addCleanup(database.close)
+        return database
+
+    def get_pooled_database(self, **pool) -> DatabaseWrapper:
+        return self.get_database(CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=True, POOL={"MIN_SIZE": 1, **pool})
+
+    @staticmethod
+    def terminate(backend: int):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s)", [backend])
+
+    def test_persistent_connection_is_reused(self):
+        database = self.get_database(CONN_MAX_AGE=600)
+        self.assertEqual(serve_request(database), serve_request(database))
+
+    def test_health_check_replaces_dropped_connection(self):
+        database = self.get_database(CONN_MAX_AGE=600, CONN_HEALTH_CHECKS=True)
+        backend = serve_request(database)
+        self.terminate(backend)
+        self.assertNotEqual(serve_request(database), backend)
+
+    def test_dropped_connection_fails_without_health_checks(self):
+        database = self.get_database(CONN_MAX_AGE=600, CONN_HEALTH_CHECKS=False)
+        self.terminate(serve_request(database))
+        with self.assertRaises(Error):
+            serve_request(database)
+
+    def test_pool_reuses_connections_between_requests(self):
+        database = self.get_pooled_database(MAX_SIZE=2)
+        backend = serve_request(database)
+        self.assertIsNone(database.connection)
+        self.assertEqual(serve_request(database), backend)
+
+    def test_pool_discards_dropped_connections(self):
+        database = self.get_pooled_database(MAX_SIZE=2)
+        backend = serve_request(database)
+        self.terminate(backend)
+        self.assertNotEqual(serve_request(database), backend)
+
+    def test_pool_waits_for_a_free_connection(self):
+        busy, waiting = self.get_pooled_database(MAX_SIZE=1, TIMEOUT=0.1), self.get_pooled_database(MAX_SIZE=1)
+        busy.ensure_connection()
+        with self.assertRaisesMessage(Error, "No database connection available within 0.1s"):
+            serve_request(waiting)
+        busy.close()
+        self.assertTrue(serve_request(waiting))
+
+    def test_connection_reuse_is_reported(self):
+        results = {result["mode"]: result for result in run_benchmarks([1], connection_requests=20)["connections"]}
+        self.assertEqual({mode: (result["requests"], result["connections"]) for mode, result in results.items()},
+                         {"per-request": (20, 20), "persistent": (20, 1), "pooled": (20, 1)})
+        self.assertTrue(all(result["wall_ms"] >= 0 for result in results.values()))
+
+
+def run_workers() -> str:
+    """Runs due jobs with the run_workers command, keeping the connection a worker would close between jobs,
+    as closing it ends the transaction of the test case"""
+    out = StringIO()
+    with mock.patch("app.jobs.close_old_connections"):
+        call_command("run_workers", "--burst", stdout=out)
+    return out.getvalue()
+
+
+def create_product_job(name: str, fail: bool = False):
+    """Task of the job queue tests"""
+    baker.make(Product, name=name)
+    if fail:
+        raise ValueError(f"{name} failed")
+
+
+class JobQueueTests(APITestCase):
+
+    def test_job_runs_and_is_deleted(self):
+        enqueue(create_product_job, name="Cream")
+        self.assertTrue(run_next_job())
+        self.assertTrue(Product.objects.filter(name="Cream").exists())
+        self.assertFalse(Job.objects.exists())
+        self.assertFalse(run_next_job())
+
+    def test_job_of_rolled_back_transaction_is_not_queued(self):
+        with self.assertRaises(ValueError), transaction.atomic():
+            enqueue(create_product_job, name="Cream")
+            raise ValueError
+        self.assertFalse(Job.objects.exists())
+
+    def test_failed_job_is_retried_with_backoff(self):
+        job = enqueue(create_product_job, name="Cream", fail=True)
+        self.assertTrue(run_next_job())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("queued", 1))
+        self.assertIn("ValueError: Cream failed", job.last_error)
+        self.assertGreater(job.run_at, timezone.now() + timedelta(seconds=RETRY_DELAY - 1))
+        self.assertFalse(Product.objects.exists())
+        self.assertFalse(run_next_job())
+
+    def test_job_fails_after_max_attempts(self):
+        job = enqueue(create_product_job, name="Cream", fail=True)
+        for _ in range(job.max_attempts):
+            Job.objects.update(run_at=timezone.now())
+            run_next_job()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("failed", job.max_attempts))
+        Job.objects.update(run_at=timezone.now())
+        self.assertFalse(run_next_job())
+
+    def test_retry_delay_doubles_up_to_limit(self):
+        self.assertEqual([get_retry_delay(attempts).total_seconds() for attempts in (1, 2, 3, 20)],
+                         [RETRY_DELAY, RETRY_DELAY * 2, RETRY_DELAY * 4, MAX_RETRY_DELAY])
+
+    def test_checkout_queues_order_confirmation(self):
+        user = baker.make(User, email="foo@bar.com", first_name="Foo")
+        baker.make(CartItem, user=user, price=5, quantity=1, product__stock=1)
+        self.client.force_authenticate(user)
+        order_id = self.client.post(reverse("order-list"), {"paid": True}).data["id"]
+        self.assertEqual(list(Job.objects.values_list("task", "kwargs")),
+                         [("app.notifications.send_order_confirmation", {"order_id": order_id})])
+        self.assertEqual(mail.outbox, [])
+        self.assertIn("Ran 1 jobs", run_workers())
+        self.assertEqual([(email.subject, email.to) for email in mail.outbox],
+                         [(f"Order {order_id} confirmation", ["foo@bar.com"])])
+
+
+class JobWorkerTests(APITransactionTestCase):
+    databases = "__all__"
+
+    def test_workers_skip_jobs_claimed_by_others(self):
+        claimed = enqueue(create_product_job, name="Cream")
+        enqueue(create_product_job, name="Serum")
+        worker = DatabaseWrapper(dict(connection.settings_dict), alias=connection.alias)
+        self.addCleanup(worker.close)
+        worker.set_autocommit(False)
+        with worker.cursor() as cursor:
+            cursor.execute(f"SELECT id FROM {Job._meta.db_table} WHERE id = %s FOR UPDATE", [claimed.id])
+        self.assertTrue(run_next_job())
+        self.assertEqual(list(Product.objects.values_list("name", flat=True)), ["Serum"])
+        self.assertEqual(list(Job.objects.values_list("id", flat=True)), [claimed.id])
+        self.assertFalse(run_next_job())
+        worker.rollback()
+        self.assertTrue(run_next_job())
+        self.assertEqual(sorted(Product.objects.values_list("name", flat=True)), ["Cream", "Serum"])
+        self.assertFalse(Job.objects.exists())
+
+    def test_stopped_worker_finishes_without_waiting(self):
+        stop = threading.Event()
+        stop.set()
+        self.assertEqual(work(stop, poll_interval=60), 0)
+
+
+class ConcurrentIdempotentOrderTests(APITransactionTestCase):
+    databases = "__all__"
+
+    def _post(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        try:
+            return client.post(reverse("order-list"), {"paid": True}, HTTP_IDEMPOTENCY_KEY="checkout-1")
+        finally:
+            connections.close_all()
+
+    def test_concurrent_duplicate_waits_for_first_response(self):
+        user, product = baker.make(User), baker.make(Product, stock=5)
+        baker.make(CartItem, user=user, product=product, price=10, quantity=2)
+        # the first checkout holds the key while the duplicate arrives
+        with mock.patch("app.serializers.enqueue", side_effect=lambda *args, **kwargs: time.sleep(0.5)), \
+                ThreadPoolExecutor(max_workers=2) as executor:
+            responses = list(executor.map(self._post, [user, user]))
+        self.assertEqual([response.status_code for response in responses], [status.HTTP_201_CREATED] * 2)
+        self.assertEqual(len({response.data["id"] for response in responses}), 1)
+        self.assertEqual(sum(response.has_header(REPLAYED_HEADER) for response in responses), 1)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Product.objects.get().stock, 3)
+
+
+class ConcurrentCheckoutTests(APITransactionTestCase):
+    # reads outside of transactions, the assertions among them, go to replicas if there are any
+    databases = "__all__"
+    checkouts = 200
+    workers = 16
+
+    def setUp(self):
+        super().setUp()
+        self.products = baker.make(Product, stock=150, _quantity=2)
+        self.users = baker.make(User, _quantity=self.checkouts)
+        for user in self.users:
+            # half of the carts list products in reverse order to provoke lock ordering deadlocks
+            for product in self.products[::1 if user.id % 2 else -1]:
+                baker.make(CartItem, user=user, product=product, price=1, quantity=1)
+
+    def _checkout(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        started = time.monotonic()
+        try:
+            return client.post(reverse("order-list"), {"paid": True}).status_code, time.monotonic() - started
+        finally:
+            connections.close_all()
+
+    def test_concurrent_checkouts_do_not_oversell(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(self._checkout, self.users, timeout=120))
+        statuses = Counter(status_code for status_code, _ in results)
+        self.assertEqual(statuses, {status.HTTP_201_CREATED: 150, status.HTTP_400_BAD_REQUEST: 50})
+        self.assertEqual(list(Product.objects.values_list("stock", flat=True)), [0, 0])
+        self.assertEqual(OrderItem.objects.count(), 300)
+        self.assertLess(max(duration for _, duration in results), 10)
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class ReplicaRoutingTests(APITransactionTestCase):
+    """Checks routing decisions, without a replica database unless the suite runs with DB_REPLICA_HOSTS"""
+
+    def _serve(self, request, view=lambda: None) -> tuple[list[str], HttpResponse]:
+        databases = []
+
+        def get_response(request):
+            databases.append(router.db_for_read(Product))
+            view()
+            databases.append(router.db_for_read(Product))
+            return HttpResponse()
+        return databases, ReplicaPinMiddleware(get_response)(request)
+
+    def test_reads_go_to_replicas_and_writes_to_primary(self):
+        self.assertEqual(router.db_for_read(Product), "replica")
+        self.assertEqual(router.db_for_write(Product), "default")
+
+    def test_reads_in_transaction_go_to_primary(self):
+        with transaction.atomic():
+            self.assertEqual(router.db_for_read(CartItem), "default")
+
+    def test_related_objects_are_read_from_database_of_instance(self):
+        product = baker.prepare(Product)
+        product._state.db = "default"
+        self.assertEqual(router.db_for_read(ProductRating, instance=product), "default")
+
+    def test_request_writing_is_pinned_to_primary(self):
+        databases, response = self._serve(RequestFactory().post("/"), lambda: router.db_for_write(CartItem))
+        self.assertEqual(databases, ["replica", "default"])
+        self.assertEqual(response.cookies[PIN_COOKIE]["max-age"], settings.DATABASE_REPLICA_PIN_SECONDS)
+
+    def test_reading_request_is_not_pinned(self):
+        databases, response = self._serve(RequestFactory().get("/"))
+        self.assertEqual(databases, ["replica", "replica"])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_client_reads_primary_within_pin_window(self):
+        request = RequestFactory().get("/")
+        request.COOKIES[PIN_COOKIE] = str(time.time() + 5)
+        self.assertEqual(self._serve(request)[0], ["default", "default"])
+        for expired in (str(time.time() - 1), "invalid"):
+            request.COOKIES[PIN_COOKIE] = expired
+            self.assertEqual(self._serve(request)[0], ["replica", "replica"])
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_pin_middleware_is_not_used_without_replicas(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ReplicaPinMiddleware(lambda request: HttpResponse())
+
+
+class ReplicaReadYourWritesTests(APITransactionTestCase):
+    """Runs against the replicas of DB_REPLICA_HOSTS, which mirror the default test database"""
+    databases = "__all__"
+
+    def setUp(self):
+        if not settings.DATABASE_REPLICAS:
+            self.skipTest("no replica databases are configured")
+        self.user, self.product = baker.make(User), baker.make(Product, stock=5)
+        self.client.force_authenticate(self.user)
+
+    def _count_queries(self, method: str, url: str, data=None) -> dict:
+        with ExitStack() as stack:
+            contexts = {alias: stack.enter_context(CaptureQueriesContext(connections[alias]))
+                        for alias in ["default", *settings.DATABASE_REPLICAS]}
+            getattr(self.client, method)(url, data)
+        return {alias: len(context) for alias, context in contexts.items() if len(context)}
+
+    def test_catalog_is_read_from_replica(self):
+        queries = self._count_queries("get", reverse("product-list"))
+        self.assertNotIn("default", queries)
+
+    def test_cart_is_read_from_primary_after_write(self):
+        self._count_queries("post", reverse("cart-list"), {"product": self.product.id, "quantity": 1})
+        self.assertEqual(list(self._count_queries("get", reverse("cart-list"))), ["default"])
+        self.client.cookies.pop(PIN_COOKIE)
+        self.assertNotIn("default", self._count_queries("get", reverse("cart-list")))
+
+
+class APIBenchmarkTests(APITestCase):
+
+    def test_query_count_does_not_grow_with_catalog_size(self):
+        report = run_benchmarks([2, 12])
+        self.assertEqual(report["query_growth"], [])
+        self.assertEqual(len(report["results"]), 2 * len(ENDPOINTS))
+        self.assertTrue(all(result["status"] < 400 for result in report["results"]), report["results"])
+        self.assertEqual(json.loads(json.dumps(report))["sizes"], [2, 12])
+
+    def test_serializers_are_compared(self):
+        results = benchmark_serialization(30, repeat=1)
+        self.assertEqual([result["endpoint"] for result in results], ["products-list", "cart-list"])
+        self.assertTrue(all(result["rows"] == 30 and result["speedup"] > 0 for result in results), results)
+
+    def test_handlers_are_compared(self):
+        results = benchmark_handlers(3, size=5)
+        self.assertEqual({(result["endpoint"], result["handler"]) for result in results},
+                         {(name, handler) for name, *_ in HANDLER_ENDPOINTS for handler in ("wsgi", "asgi")})
+        self.assertTrue(all(result["statuses"] == [200] for result in results), results)
+        self.assertFalse(Product.objects.exists())
+
+    def test_query_growth_is_reported(self):
+        results = [{"endpoint": "cart-list", "queries": 2}, {"endpoint": "cart-list", "queries": 3},
+                   {"endpoint": "orders-list", "queries": 3}, {"endpoint": "orders-list", "queries": 3}]
+        self.assertEqual(find_query_growth(results), ["cart-list"])
+
+
+class SQLInstrumentationMiddlewareTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.products = baker.make(Product, _quantity=3)
+
+    def _get_response(self, request):
+        for product in self.products:
+            Product.objects.filter(pk=product.pk).exists()
+        return HttpResponse()
+
+    def _call(self, **config):
+        with override_settings(SQL_INSTRUMENTATION={"N_PLUS_ONE_THRESHOLD": 3, **config}):
+            middleware = SQLInstrumentationMiddleware(self._get_response)
+        return middleware(RequestFactory().get("/products/"))
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse("product-list"))
+        self.assertRegex(response["Server-Timing"], r'^db;dur=[\d.]+;desc="1 queries", app;dur=[\d.]+$')
+
+    def test_repeated_queries_logged(self):
+        with self.assertLogs("app.sql", level="WARNING") as logs:
+            response = self._call()
+        summary = logs.records[0].sql_summary
+        self.assertIn('desc="3 queries"', response["Server-Timing"])
+        self.assertEqual((summary["path"], summary["queries"]), ("/products/", 3))
+        self.assertEqual(summary["repeated"][0]["count"], 3)
+
+    def test_slow_request_logged(self):
+        with self.assertLogs("app.sql", level="WARNING") as logs:
+            self._call(N_PLUS_ONE_THRESHOLD=4, SLOW_REQUEST_MS=0, SLOW_QUERY_MS=0)
+        summary = logs.records[0].sql_summary
+        self.assertEqual((summary["repeated"], len(summary["slow_queries"])), ([], 3))
+
+    def test_fast_request_not_logged(self):
+        with self.assertNoLogs("app.sql", level="WARNING"):
+            self._call(N_PLUS_ONE_THRESHOLD=4)
+
+    def test_unsampled_request(self):
+        response = self._call(SAMPLE_RATE=0)
+        self.assertNotIn("Server-Timing", response)
+
+    def test_disabled(self):
+        with override_settings(SQL_INSTRUMENTATION={"ENABLED": False}), self.assertRaises(MiddlewareNotUsed):
+            SQLInstrumentationMiddleware(self._get_response)
+
+
+class JSONRendererTests(APITestCase):
+    data = {
+        "price": Decimal("10.90"),
+        "tracking_number": uuid.UUID("c0a80101-0000-4000-8000-000000000001"),
+        "created": datetime(2022, 6, 1, 12, 30, 5, 123456, tzinfo=dt_timezone.utc),
+        "shipped": datetime(2022, 6, 1, 12, 30, tzinfo=dt_timezone(timedelta(hours=2))),
+        "day": date(2022, 6, 1),
+        "name": "Krém \u2028 \u2029 \"night\"",
+        1: [None, True, 1.5, 10 ** 20],
+    }
+
+    def test_output_matches_drf_renderer(self):
+        for data in (self.data, [self.data], {}, []):
+            self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_indent_and_stdlib_fallback(self):
+        with mock.patch("app.renderers.orjson.dumps") as dumps:
+            indented = FastJSONRenderer().render(self.data, "application/json; indent=4")
+            with override_settings(JSON_BACKEND="json"):
+                rendered = FastJSONRenderer().render(self.data)
+        dumps.assert_not_called()
+        self.assertEqual(indented, JSONRenderer().render(self.data, "application/json; indent=4"))
+        self.assertEqual(rendered, JSONRenderer().render(self.data))
+
+    def test_parser(self):
+        self.assertEqual(FastJSONParser().parse(BytesIO(b'{"price": 10.9, "name": "Kr\\u00e9m"}')),
+                         {"price": 10.9, "name": "Krém"})
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(BytesIO(b'{"price": NaN}'))
+
+    def test_api_requests(self):
+        product = baker.make(Product)
+        self.client.force_authenticate(baker.make(User))
+        response = self.client.post(reverse("rating-list"), {"product": product.id, "rating": 5, "comment": "Nice"},
+                                    format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.post(reverse("rating-list"), b"{broken", content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_benchmark(self):
+        results = benchmark_rendering(100, repeat=2)
+        self.assertEqual([result["payload"] for result in results], ["products-list", "orders-list"])
+        self.assertTrue(all(result["bytes"] > 0 for result in results))
+
+
+class MetricsTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        get_catalog_cache().clear()
+        self.user = baker.make(User)
+        self.product = baker.make(Product, stock=1)
+
+    @staticmethod
+    def _sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_request_metrics_by_viewset_action(self):
+        labels = {"view": "ProductViewSet", "action": "list", "method": "GET", "status": "200"}
+        requests = self._sample("eshop_request_duration_seconds_count", **labels)
+        serializer = {"serializer": "ProductRowSerializer"}
+        serializations = self._sample("eshop_serializer_duration_seconds_count", **serializer)
+        self.client.get(reverse("product-list"))
+        self.client.get(reverse("product-list"))
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b"eshop_request_db_duration_seconds_bucket", response.content)
+        self.assertEqual(self._sample("eshop_request_duration_seconds_count", **labels), requests + 2)
+        self.assertEqual(self._sample("eshop_serializer_duration_seconds_count", **serializer), serializations + 1)
+
+    def test_metrics_are_restricted(self):
+        staff = baker.make(User, is_staff=True)
+        self.assertEqual(self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1").status_code,
+                         status.HTTP_403_FORBIDDEN)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1").status_code,
+                         status.HTTP_403_FORBIDDEN)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1").status_code, status.HTTP_200_OK)
+
+    def test_catalog_cache_metrics(self):
+        hits, misses = self._sample("eshop_catalog_cache_requests_total", result="hit"), \
+            self._sample("eshop_catalog_cache_requests_total", result="miss")
+        self.client.get(reverse("product-list"))
+        self.client.get(reverse("product-list"))
+        self.assertEqual(self._sample("eshop_catalog_cache_requests_total", result="hit"), hits + 1)
+        self.assertEqual(self._sample("eshop_catalog_cache_requests_total", result="miss"), misses + 1)
+
+    def test_checkout_outcome_metrics(self):
+        successes = self._sample("eshop_checkouts_total", outcome="success")
+        sold_out = self._sample("eshop_checkouts_total", outcome="out_of_stock")
+        self.client.force_authenticate(self.user)
+        for _ in range(2):
+            baker.make(CartItem, user=self.user, product=self.product, quantity=1)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse("order-list"), {"paid": True})
+        self.assertEqual(self._sample("eshop_checkouts_total", outcome="success"), successes + 1)
+        self.assertEqual(self._sample("eshop_checkouts_total", outcome="out_of_stock"), sold_out + 1)
+
 
 class CartItemGetTests(APITestCase):
 
@@ -185,7 +1628,7 @@ class CartItemGetTests(APITestCase):
         password = "some_password"  # noqa: S105
         self.user.set_password(password)
         self.user.save()
-        self.cart = baker.make(CartItem, user=self.user, _quantity=5)
+        self.cart = baker.make(CartItem, user=self.user, quantity=1, _quantity=5)
 
         self.url = reverse("cart-list")
 
@@ -196,6 +1639,145 @@ class CartItemGetTests(APITestCase):
         self.assertEqual(CartItem.objects.filter(user=self.user).count(), 5)
 
 
+@override_settings(CART_STORE={"BACKEND": "app.carts.KeyValueCartStore", "LOCATION": "", "IDLE_FLUSH_SECONDS": 0})
+class KeyValueCartStoreTests(APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = baker.make(User)
+        self.product = baker.make(Product, name="Hydrating cream", price=10, stock=5)
+        self.url = reverse("cart-list")
+        self.client.force_authenticate(self.user)
+        # a new store, with an empty memory, for every test
+        get_cart_store.cache_clear()
+
+    def _add(self, quantity: int = 2):
+        return self.client.post(self.url, {"product": self.product.id, "quantity": quantity})
+
+    def test_add_to_cart_does_not_write_to_database(self):
+        with CaptureQueriesContext(connection) as queries:
+            self._add()
+            response = self._add()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {"user": self.user.id, "price": 10, "quantity": 4,
+                                         "product": {"id": self.product.id, "name": "Hydrating cream"}})
+        self.assertFalse([query for query in queries.captured_queries if not query["sql"].startswith("SELECT")])
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_cart_is_loaded_from_cart_items(self):
+        baker.make(CartItem, user=self.user, product=self.product, price=8, quantity=3)
+        self.assertEqual(self.client.get(self.url).json(), [
+            {"user": self.user.id, "product": {"id": self.product.id, "name": "Hydrating cream"}, "price": 8.0,
+             "quantity": 3}])
+        self.assertEqual(self._add().data["quantity"], 5)
+
+    def test_cart_not_modified(self):
+        self._add()
+        etag = self.client.get(self.url)["ETag"]
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        self._add()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_checkout_reads_cart_from_store(self):
+        self._add()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("order-list"), {"paid": True})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["total_amount"], 20)
+        self.assertEqual(list(OrderItem.objects.values_list("product", "quantity")), [(self.product.id, 2)])
+        self.assertEqual(self.client.get(self.url).json(), [])
+
+    def test_failed_checkout_keeps_cart(self):
+        self._add(quantity=6)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("order-list"), {"paid": True})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.url).json()[0]["quantity"], 6)
+
+    def test_idle_carts_are_written_back(self):
+        self._add()
+        out = StringIO()
+        call_command("flush_carts", stdout=out)
+        self.assertIn("Flushed 1 idle carts", out.getvalue())
+        self.assertEqual(list(CartItem.objects.values_list("user", "product", "price", "quantity")),
+                         [(self.user.id, self.product.id, 10, 2)])
+        self.assertEqual(get_cart_store().client.hgetall(f"cart:{self.user.id}"), {})
+        self.assertEqual(self._add().data["quantity"], 4)
+
+    def test_cart_changed_during_flush_is_kept(self):
+        self._add()
+        store = get_cart_store()
+        write_back = store.write_back
+
+        def add_during_write_back(user_id, items):
+            write_back(user_id, items)
+            store.add(self.user, self.product, 1)
+
+        with mock.patch.object(store, "write_back", side_effect=add_during_write_back):
+            store.flush(self.user.id)
+        self.assertEqual(store.get_items(self.user)[0].quantity, 3)
+        self.assertEqual(store.client.zrangebyscore("cart:dirty", 0, float("inf")), [str(self.user.id)])
+        store.flush(self.user.id)
+        self.assertEqual(list(CartItem.objects.values_list("quantity", flat=True)), [3])
+
+    def test_checkout_during_flush_is_not_written_back(self):
+        self._add()
+        store = get_cart_store()
+        write_back = store.write_back
+        checked_out = [f"q:{self.product.id}", f"p:{self.product.id}"]
+
+        def checkout_during_write_back(user_id, items):
+            write_back(user_id, items)
+            store.drop(user_id, checked_out)
+
+        with mock.patch.object(store, "write_back", side_effect=checkout_during_write_back):
+            store.flush(self.user.id)
+        self.assertEqual(store.get_items(self.user), [])
+        store.flush(self.user.id)
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(store.client.zrangebyscore("cart:dirty", 0, float("inf")), [])
+
+    def test_checkout_marks_cart_changed(self):
+        self._add()
+        store = get_cart_store()
+        store.client.delete("cart:dirty")
+        updated = store.client.hget(f"cart:{self.user.id}", "updated")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("order-list"), {"paid": True})
+        self.assertNotEqual(store.client.hget(f"cart:{self.user.id}", "updated"), updated)
+        self.assertEqual(store.client.zrangebyscore("cart:dirty", 0, float("inf")), [str(self.user.id)])
+
+    def test_anonymous_user_has_no_cart(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_several_workers_require_location(self):
+        get_cart_store.cache_clear()
+        with mock.patch.dict(os.environ, {"WEB_CONCURRENCY": "2"}), self.assertRaises(ImproperlyConfigured):
+            get_cart_store()
+
+
+# a Redis server to run the cart store tests against, e.g. redis://localhost:6379/15; its cart keys are deleted
+REDIS_TEST_URL = os.getenv("REDIS_TEST_URL", "")
+
+
+@skipUnless(redis and REDIS_TEST_URL, "the redis package or REDIS_TEST_URL is not available")
+@override_settings(CART_STORE={"BACKEND": "app.carts.KeyValueCartStore", "LOCATION": REDIS_TEST_URL,
+                               "IDLE_FLUSH_SECONDS": 0})
+class RedisCartStoreTests(KeyValueCartStoreTests):
+
+    def setUp(self):
+        super().setUp()
+        client = get_cart_store().client
+        self.addCleanup(client.delete, f"cart:{self.user.id}", "cart:dirty")
+        client.delete("cart:dirty")
+
+    def test_several_workers_require_location(self):
+        get_cart_store.cache_clear()
+        with mock.patch.dict(os.environ, {"WEB_CONCURRENCY": "2"}):
+            self.assertIsInstance(get_cart_store().client, redis.Redis)
+
+
 class CartItemPostTests(APITestCase):
 
     def setUp(self):
@@ -228,3 +1810,40 @@ class CartItemPostTests(APITestCase):
         data = self._get_data()
         response = self.client.post(self.url, data)
         self.assertEqual(response.data["quantity"], 4)
+
+    def test_add_to_cart_is_a_single_statement(self):
+        self.client.force_authenticate(self.user)
+        baker.make(CartItem, user=self.user, product=self.product, price=8, quantity=2)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, self._get_data())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["product"], {"id": self.product.id, "name": self.product.name})
+        self.assertEqual(response.data["price"], 10)
+        self.assertEqual(sum(query["sql"].lstrip().startswith("INSERT") for query in queries.captured_queries), 1)
+        self.assertFalse(any(query["sql"].startswith("DELETE") for query in queries.captured_queries))
+        self.assertEqual(CartItem.objects.get(user=self.user).quantity, 4)
+
+    def test_quantity_below_one_is_rejected(self):
+        self.client.force_authenticate(self.user)
+        baker.make(CartItem, user=self.user, product=self.product, price=10, quantity=2)
+        for quantity in (0, -2):
+            response = self.client.post(self.url, {"product": self.product.id, "quantity": quantity})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn("quantity", response.data)
+        self.assertEqual(CartItem.objects.get(user=self.user).quantity, 2)
+
+    def test_quantity_below_one_violates_constraint(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            baker.make(CartItem, user=self.user, product=self.product, quantity=0)
+
+    def test_empty_cart_items_are_removed_and_logged(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE app_cartitem DROP CONSTRAINT cartitem_quantity_positive")
+        empty = baker.make(CartItem, user=self.user, product=self.product, quantity=0)
+        item = baker.make(CartItem, user=self.user, quantity=1)
+        migration = import_module("app.migrations.0016_remove_empty_cart_items")
+        with self.assertLogs("app.migrations", "WARNING") as logs:
+            migration.remove_empty_cart_items(apps, None)
+        self.assertEqual(list(CartItem.objects.values_list("id", flat=True)), [item.id])
+        self.assertIn(f'"id": {empty.id}', logs.output[0])
+        self.assertIn("Removed 1 empty cart items", logs.output[1])
@@ -11,4 +11,6 @@ router.register(r'cart', views.CartItemViewSet, basename="cart")
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('async/products/', views.async_product_list, name="async-product-list"),
+    path('async/products/<int:pk>/', views.async_product_detail, name="async-product-detail"),
 ]
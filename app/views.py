@@ -1,25 +1,119 @@
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import filters, mixins, viewsets
+from prometheus_client import CONTENT_TYPE_LATEST
+from rest_framework import mixins, viewsets
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from app.cache import CatalogCacheMixin, ConditionalListMixin, ConditionalResponseMixin, ConditionalRetrieveMixin, \
+    get_async_catalog_response
+from app.carts import get_cart_store
+from app.exports import OUTPUTS, stream_export
+from app.filters import CategoryFilter, ProductSearchFilter, trigram_available
+from app.idempotency import IdempotentCreateMixin
+from app.metrics import render_metrics
+from app.models import Order, Product
+from app.pagination import OrderPagination, ProductPagination
+from app.serializers import CartItemRowSerializer, CartItemSerializer, OrderDetailSerializer, OrderSerializer, \
+    ProductExportParamsSerializer, ProductRowSerializer, ProductSerializer, ProductInfoSerializer, \
+    ProductRatingSerializer
+
+
+class RowListMixin(mixins.ListModelMixin):
+    """Lists `.values()` rows serialized by `row_serializer_class` instead of model instances
+    serialized by the serializer class, which the other actions keep using"""
+    row_serializer_class: type
+
+    def list(self, request, *args, **kwargs):
+        row_serializer = self.row_serializer_class(self.get_serializer_context())
+        queryset = self.filter_queryset(self.get_queryset())
+        rows = queryset.values(*row_serializer.fields, *self.get_ordering_fields(queryset))
+        page = self.paginate_queryset(rows)
+        if page is None:
+            return Response(row_serializer.serialize(rows))
+        return self.get_paginated_response(row_serializer.serialize(page))
+
+    async def alist(self):
+        """Data of the list for async views, the page is read with the async ORM"""
+        row_serializer = self.row_serializer_class(self.get_serializer_context())
+        queryset = self.filter_queryset(self.get_queryset())
+        rows = queryset.values(*row_serializer.fields, *self.get_ordering_fields(queryset))
+        page = await self.paginator.apaginate_queryset(rows, self.request, view=self)
+        return self.get_paginated_response(row_serializer.serialize(page)).data
 
-from app.filters import CategoryFilter
-from app.models import CartItem, Order, Product
-from app.serializers import CartItemSerializer, OrderSerializer, \
-    ProductSerializer, ProductInfoSerializer, ProductRatingSerializer
+    def get_ordering_fields(self, queryset) -> tuple[str, ...]:
+        """Fields keyset pagination takes the position of the last row from"""
+        if self.paginator is None:
+            return ()
+        return tuple(field.lstrip("-") for field in self.paginator.get_ordering(self.request, queryset, self))
 
 
-class ProductViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
-    """Provides products list and product details with description"""
-    queryset = Product.objects.prefetch_related("ratings").all()
-    filter_backends = (DjangoFilterBackend, filters.SearchFilter)
+class ProductViewSet(CatalogCacheMixin, RowListMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """Provides products list and product details with description, served from the catalog cache"""
+    queryset = Product.objects.all()
+    row_serializer_class = ProductRowSerializer
+    pagination_class = ProductPagination
+    filter_backends = (DjangoFilterBackend, ProductSearchFilter)
     filterset_class = CategoryFilter
-    search_fields = ["$name"]
 
     def get_serializer_class(self):
         if self.action == "retrieve":
             return ProductInfoSerializer
         return ProductSerializer
 
+    async def aretrieve(self):
+        """Data of product details for async views, read with aget along with the ratings"""
+        queryset = self.filter_queryset(self.get_queryset()).prefetch_related("ratings")
+        try:
+            product = await queryset.aget(pk=self.kwargs["pk"])
+        except Product.DoesNotExist:
+            raise Http404
+        return self.get_serializer(product).data
+
+    @action(detail=False, pagination_class=None)
+    def export(self, request):
+        """Streams the whole catalog, or products changed since `updated_since`, as NDJSON or CSV,
+        optionally gzipped. Filters and search of the list apply"""
+        params = ProductExportParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        queryset = self.filter_queryset(self.get_queryset()).order_by("id")
+        if updated_since := params.validated_data.get("updated_since"):
+            queryset = queryset.filter(updated__gte=updated_since)
+        output, compress = params.validated_data["output"], "compression" in params.validated_data
+        content_type, extension = OUTPUTS[output]
+        storage = Product._meta.get_field("image").storage
+        response = StreamingHttpResponse(
+            stream_export(queryset, output, compress, lambda name: request.build_absolute_uri(storage.url(name))),
+            content_type="application/gzip" if compress else content_type)
+        response["Content-Disposition"] = f'attachment; filename="products.{extension}{".gz" if compress else ""}"'
+        return response
+
+
+async def async_product_list(request):
+    """Products list and search for ASGI servers, served from the catalog cache or read with the async ORM"""
+    return await get_async_catalog_response(request, partial(get_async_product_data, request, "list"))
+
+
+async def async_product_detail(request, pk):
+    """Product details for ASGI servers, served from the catalog cache or read with the async ORM"""
+    return await get_async_catalog_response(request, partial(get_async_product_data, request, "retrieve", pk=pk))
+
+
+async def get_async_product_data(request, action: str, **kwargs):
+    """Runs the async variant of a ProductViewSet action, so filters, search, pagination and serializers
+    stay those of the viewset"""
+    view = ProductViewSet(request=Request(request), args=(), kwargs=kwargs, action=action, format_kwarg=None)
+    # looked up once per process, in a thread, so the search filter never queries from the event loop
+    await sync_to_async(trigram_available)(view.get_queryset().db)
+    return await getattr(view, f"a{action}")()
+
 
 class ProductRatingViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
     """Creates rating for """
@@ -27,21 +121,43 @@ class ProductRatingViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
     permission_classes = [IsAuthenticated]
 
 
-class UserOrdersViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.CreateModelMixin,
-                        viewsets.GenericViewSet):
+class UserOrdersViewSet(ConditionalListMixin, ConditionalRetrieveMixin, IdempotentCreateMixin, mixins.ListModelMixin,
+                        mixins.RetrieveModelMixin, mixins.CreateModelMixin, viewsets.GenericViewSet):
     """Provides all orders of current user,
-     creates order from cart items deleting previous cart items"""
+     creates order from cart items deleting previous cart items, once per Idempotency-Key header"""
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = OrderPagination
 
     def get_queryset(self):
-        return Order.objects.prefetch_related("ordered_items")\
-            .select_related("user").filter(user=self.request.user.id).order_by("-created")
+        # lists read order rows alone, with the summary of their lines
+        orders = Order.objects.filter(user=self.request.user.id).order_by("-created")
+        if self.action == "retrieve":
+            return orders.prefetch_related("items")
+        return orders
+
+    def get_serializer_class(self):
+        if self.action in ("retrieve", "create"):
+            return OrderDetailSerializer
+        return OrderSerializer
 
 
-class CartItemViewSet(mixins.CreateModelMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
-    """Adds specific item to cart, shows all items in cart"""
+class CartItemViewSet(ConditionalResponseMixin, mixins.CreateModelMixin, viewsets.GenericViewSet):
+    """Adds specific item to cart, shows all items in cart, both kept by the cart store"""
     serializer_class = CartItemSerializer
+    permission_classes = [IsAuthenticated]
 
-    def get_queryset(self):
-        return CartItem.objects.select_related("product").filter(user=self.request.user.id)
+    def list(self, request, *args, **kwargs):
+        validators = get_cart_store().get_validators(request.user)
+        return self.get_conditional_response(self.list_items, validators, request, *args, **kwargs)
+
+    def list_items(self, request, *args, **kwargs):
+        rows = get_cart_store().get_rows(request.user)
+        return Response(CartItemRowSerializer(self.get_serializer_context()).serialize(rows))
+
+
+def metrics(request):
+    """Exposes metrics in the Prometheus text format to METRICS_ALLOWED_IPS and staff users"""
+    if request.META["REMOTE_ADDR"] not in settings.METRICS_ALLOWED_IPS and not request.user.is_staff:
+        raise PermissionDenied
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
@@ -39,6 +39,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'app',
     'rest_framework',
     'django_filters',
@@ -46,6 +47,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app.middleware.MetricsMiddleware',
+    'app.middleware.SQLInstrumentationMiddleware',
+    'app.middleware.ReplicaPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,6 +59,16 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# per request query counting and timing, see app.middleware
+SQL_INSTRUMENTATION = {
+    'ENABLED': os.getenv('SQL_INSTRUMENTATION_ENABLED', 'true') == 'true',
+    'SAMPLE_RATE': float(os.getenv('SQL_INSTRUMENTATION_SAMPLE_RATE', 1.0)),
+    'SLOW_REQUEST_MS': int(os.getenv('SQL_INSTRUMENTATION_SLOW_REQUEST_MS', 500)),
+    'SLOW_QUERY_MS': int(os.getenv('SQL_INSTRUMENTATION_SLOW_QUERY_MS', 100)),
+    'N_PLUS_ONE_THRESHOLD': int(os.getenv('SQL_INSTRUMENTATION_N_PLUS_ONE_THRESHOLD', 10)),
+    'SERVER_TIMING': True,
+}
+
 ROOT_URLCONF = 'eshop.urls'
 
 TEMPLATES = [
@@ -79,19 +93,85 @@ WSGI_APPLICATION = 'eshop.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
+# connections are pooled per process and returned to the pool after every request, so they never outlive
+# the request on threads of ASGI servers either. Without the pool, a connection is kept for DB_CONN_MAX_AGE seconds
+DB_POOL = os.getenv('DB_POOL', 'false') == 'true'
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        # PostgreSQL with health checks and pooling, see app.db.base
+        'ENGINE': 'app.db',
         'NAME': 'postgres',
         'USER': 'postgres',
         'HOST': 'db',
         'PASSWORD': 'postgres',
         'PORT': 5432,
+        'CONN_MAX_AGE': 0 if DB_POOL else int(os.getenv('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': os.getenv('DB_CONN_HEALTH_CHECKS', 'true') == 'true',
+        'POOL': {
+            'MIN_SIZE': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+            'MAX_SIZE': int(os.getenv('DB_POOL_MAX_SIZE', 20)),
+            'TIMEOUT': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        } if DB_POOL else None,
+    }
+}
+
+# comma separated hosts of read replicas of the default database, reads are spread over them, see app.routers.
+# Test databases of replicas mirror the default one
+DATABASES.update({
+    f'replica_{index}': {**DATABASES['default'], 'HOST': host, 'TEST': {'MIRROR': 'default'}}
+    for index, host in enumerate(filter(None, os.getenv('DB_REPLICA_HOSTS', '').split(',')))
+})
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['app.routers.ReplicaRouter']
+# seconds a client keeps reading from the primary after a write, so it reads its own writes
+DATABASE_REPLICA_PIN_SECONDS = int(os.getenv('DB_REPLICA_PIN_SECONDS', 5))
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
     }
 }
 
+# cache alias and timeout (seconds) of product list and detail responses
+CATALOG_CACHE_ALIAS = os.getenv('CATALOG_CACHE_ALIAS', 'default')
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 60))
+
+# storage of carts, see app.carts. app.carts.KeyValueCartStore keeps them in a Redis server at LOCATION,
+# or in process memory without it, and writes carts idle for IDLE_FLUSH_SECONDS back to the database.
+# A LOCATION requires the redis package, which is optional and not among the requirements.
+# Without a LOCATION, only a single worker process may serve, see the README
+CART_STORE = {
+    'BACKEND': os.getenv('CART_STORE_BACKEND', 'app.carts.DatabaseCartStore'),
+    'LOCATION': os.getenv('CART_STORE_LOCATION', ''),
+    'IDLE_FLUSH_SECONDS': int(os.getenv('CART_STORE_IDLE_FLUSH_SECONDS', 900)),
+}
+
+# seconds responses to requests with an Idempotency-Key header are replayed to retries, see app.idempotency.
+# purge_idempotency_keys deletes older ones
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+
+# addresses allowed to read /metrics, besides staff users. Behind a proxy, this is the address of the proxy
+METRICS_ALLOWED_IPS = os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
+# "orjson" renders and parses JSON with orjson when it is installed, "json" with the standard library
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'orjson')
+
 REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING': False,
+    'DEFAULT_RENDERER_CLASSES': [
+        'app.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'app.renderers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
 
@@ -135,6 +215,13 @@ STATIC_ROOT = os.getenv('STATIC_ROOT', os.path.join(BASE_DIR, 'static/'))
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.getenv('MEDIA_ROOT', os.path.join(BASE_DIR, 'media/'))
 
+# Email, sent by background jobs of the run_workers command
+# https://docs.djangoproject.com/en/4.0/topics/email/
+
+EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+EMAIL_HOST = os.getenv('EMAIL_HOST', 'localhost')
+DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'eshop@localhost')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
@@ -21,6 +21,8 @@ from django.contrib.staticfiles.views import serve
 from django.urls import include, path
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 
+from app.views import metrics
+
 
 urlpatterns = []
 
@@ -30,6 +32,7 @@ if settings.DEBUG:
 
 urlpatterns += [
     path('admin/', admin.site.urls),
+    path('metrics', metrics, name='metrics'),
     path('', include("app.urls")),
     # 3rd party apps
     path('schema/', SpectacularAPIView.as_view(), name='schema'),
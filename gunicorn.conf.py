@@ -0,0 +1,15 @@
+"""Gunicorn settings, read from the working directory by `gunicorn eshop.wsgi`"""
+import os
+
+from prometheus_client import multiprocess
+
+
+def on_starting(server):
+    """Exports the number of workers to them, see app.carts.get_memory_client"""
+    os.environ["WEB_CONCURRENCY"] = str(server.cfg.workers)
+
+
+def child_exit(server, worker):
+    """Drops the live gauge samples of an exited worker in prometheus_client multiprocess mode"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(worker.pid)